@@ -1,9 +1,19 @@
 import math
 import time
 import numpy as np
-from random import randint, seed, choice
+from collections import OrderedDict
+from multiprocessing import Pool
+from random import Random, randint, seed, choice
 from numba import jit
+from timeit import default_timer as timer
 from helpers import print_board
+from game_board import GameBoard, pack_grid
+from heuristics import (get_heuristic_tables, utility_upper_bound, packed_tile_sum,
+                        eval_packed, count_empty, eval_packed_batch, eval_packed_tables,
+                        eval_packed_tables_batch)
+from bit_board import canonical, move_packed, move_mask_packed, empty_mask_packed
+from rollouts import rollout_batch
+from telemetry import MoveStats
 
 DEBUG = False
 
@@ -15,90 +25,422 @@ dirs = {
     3: "RIGHT"
 }
 
-# get smoothness of grid
-@jit
-def get_smoothness(a):
-    s = 0
-    for i in [0,1,2,3]:
-        for j in [0,1,2,3]:
-            if a[i][j] != 0:
-                # find next occupied
-
-                # right
-                k = 1
-                while j+k < 3 and a[i][j+k] == 0:
-                    k += 1
-                if j+k <= 3 and a[i][j+k] != 0:
-                    s += abs(a[i][j] - a[i][j+k])
-
-                # down
-                k = 1
-                while i + k < 3 and a[i+k][j] == 0:
-                    k += 1
-                if i+k <= 3 and a[i+k][j] != 0:
-                    s += abs(a[i][j] - a[i+k][j])
-    return s
-
-
-def eval_board(board, n_empty):
-    # evaluate board on 4 properties:
-    # 1. max value in board
-    # 2. number of empty tiles
-    # 3. monotonicity
-    # 4. smoothness
-    # 5. snake
-
-    grid = board.grid
-
-    # weights we give to each prop
-    max_w = 1
-    empty_w = 100
-    mono_w = 10
-    smooth_w = 10
-
-    # ----- snake pattern
-    snake_w = [15,14,13,12,8,9,10,11,7,6,5,4,0,1,2,3]
-    snake_w = np.array(snake_w).reshape(4,4)
-    snake_u = np.sum(grid * snake_w)
-
-    # ----- max tile
-    max_u = np.amax(grid) * max_w
-
-    # ----- empty tiles
-    empty_u = (math.log(n_empty) * empty_w) if n_empty != 0 else 0
-
-    # ----- monotonicity
-    log_grid = np.log2(grid, where=grid != 0)   # for smoothness as well
-
-    mono_h = np.zeros((1, 4))
-    mono_v = np.zeros((1, 4))
-
-    for i in range(3):
-        mono_h += log_grid[:, i] - log_grid[:, i + 1]   # differences in horizontally adjacent
-        mono_v += log_grid[i, :] - log_grid[i + 1, :]   # differences in vertically adjacent
-
-    mono_u = (np.sum(np.abs(mono_h)) + np.sum(np.abs(mono_v))) * mono_w
-
-    # ----- smoothness
-    smooth_u = -(get_smoothness(log_grid) * smooth_w)
-
-    # ----- total
-    utility = empty_u + mono_u + smooth_u
-    utility += max_u
-    utility += snake_u
-
-    return (utility, empty_u, mono_u, smooth_u)
-
-            
+@jit('uint64[:](float64[:,:,:])', nopython=True, cache=True)
+def pack_grids(grids):
+    out = np.empty(grids.shape[0], dtype=np.uint64)
+    for n in range(grids.shape[0]):
+        out[n] = pack_grid(grids[n])
+    return out
+
+# batched eval_board: boards is an (N, 4, 4) array of tile values or an
+# array of N packed boards, n_empty is taken from the boards themselves
+def eval_batch(boards, symmetric = False):
+    boards = np.asarray(boards)
+    if boards.ndim == 3:
+        boards = pack_grids(boards.astype(np.float64))
+    return eval_packed_batch(boards.astype(np.uint64), symmetric)
+
+
+def eval_board(board, n_empty, symmetric = False):
+    # symmetric = True scores the snake in whichever of its 8 orientations
+    # fits best, which makes the whole evaluation invariant under rotations
+    # and reflections so symmetric positions can share cache entries
+    if isinstance(board, GameBoard):
+        # same utility from the board's running terms
+        return board.evaluate(n_empty, symmetric)
+    return eval_packed(np.uint64(board.key()), n_empty, symmetric)
+
+
+# -------------------- TRANSPOSITION TABLE -------------------- #
+# LRU cache of search results keyed on (board key, remaining depth)
+class TranspositionTable:
+    # approximate memory of one entry (key and utility tuples, the floats
+    # and the OrderedDict slot), ~365 bytes measured with tracemalloc
+    ENTRY_BYTES = 400
+
+    def __init__(self, max_size = 200000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        utility = self.entries.get(key)
+
+        if utility is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        return utility
+
+    def put(self, key, utility):
+        self.entries[key] = utility
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# -------------------- ITERATIVE DEEPENING -------------------- #
+# raised inside the search once the move's time budget is spent
+class SearchTimeout(Exception):
+    pass
+
+# deepest max_depth iterative deepening will try, searches past this are
+# only reached in tiny endgame trees anyway
+MAX_ID_DEPTH = 15
+
+
+# -------------------- PARALLEL SEARCH -------------------- #
+# each pool process keeps one Expectimax, so its cache survives between moves
+_worker_ai = None
+
+def init_search_worker(options):
+    global _worker_ai
+    _worker_ai = Expectimax(**options)
+
+    # first calls for Numba to compile fast versions
+    b = np.uint64(0)
+    eval_packed(b, 16, options.get('symmetric', False))
+    eval_packed_batch(np.zeros(1, dtype=np.uint64), options.get('symmetric', False))
+    count_empty(b)
+
+# task = (node, board, depth, prob, node_budget) with node either 'chance' or
+# 'maximize', returns the subtree utility, the states it visited and its
+# static fallbacks (see Expectimax node_budget)
+def search_worker(task):
+    node, board, depth, prob, node_budget = task
+    before = _worker_ai.states_visited
+    _worker_ai.start_budget(node_budget)
+
+    if node == 'chance':
+        utility = _worker_ai.chance(board, depth, prob)
+    else:
+        _, utility = _worker_ai.maximize(board, depth, prob)
+
+    return utility, _worker_ai.states_visited - before, _worker_ai.fallbacks
+
+
+# margin kept below pruning bounds, so rounding in the bound arithmetic can
+# never cut a subtree that reaches them
+def bound_slack(x):
+    return 1e-9 * (abs(x) + 1)
+
+
 # -------------------- EXPECTIMAX -------------------- #
 class Expectimax():
-    def __init__(self):
+    # cache_size = 0 turns the transposition table off
+    # symmetric = True keys the cache on the canonical form of each board and
+    # switches eval_board to its symmetry invariant snake term
+    # batch_leaves = True expands all tile insertions of a chance node before
+    # scoring their leaves with a single eval_batch call
+    # workers > 0 searches the root moves in a pool of that many processes,
+    # split_tiles = True also hands out each first tile insertion separately
+    # time_budget (ms) switches to iterative deepening, searching max_depth
+    # 1, 3, 5, ... until the budget runs out
+    # prob_cutoff evaluates statically once the probability of reaching a
+    # chance node drops below it, and past depth max_four_depth only 2 tiles
+    # are spawned (0 / None turn these off)
+    # telemetry is a telemetry.TelemetrySink getting a MoveStats per move
+    # eval_tables = True scores leaves from the precomputed heuristic tables
+    # board_stack = True plays moves into one preallocated board per max
+    # node level (board.move_into) and spawns tiles in place, removing them
+    # again after the subtree, instead of cloning at every node
+    # bounded = True prunes chance nodes that cannot reach the best utility
+    # found so far (Star1, see maximize_bounded)
+    # node_budget caps the chance nodes of one move: once it is spent every
+    # node left is evaluated statically, counted in fallbacks (with workers
+    # the budget is shared out over the root tasks). memory_limit (bytes)
+    # caps the transposition table, in each worker too
+    #
+    # Options that pick a search (time_budget, workers, bounded) or a way of
+    # expanding chance nodes (batch_leaves, board_stack) exclude each other,
+    # and telemetry only traces the plain serial search: combining them
+    # raises ValueError instead of one quietly winning
+    def __init__(self, cache_size = 200000, max_depth = 5, symmetric = False, batch_leaves = False,
+                 workers = 0, split_tiles = False, time_budget = None, prob_cutoff = 0,
+                 max_four_depth = None, telemetry = None, eval_tables = False, board_stack = False,
+                 bounded = False, node_budget = None, memory_limit = None):
+        searches = [name for name, on in (('time_budget', time_budget is not None),
+                                          ('workers', workers), ('bounded', bounded)) if on]
+        if len(searches) > 1:
+            raise ValueError('%s cannot be combined' % ' and '.join(searches))
+        if batch_leaves and board_stack:
+            raise ValueError('batch_leaves and board_stack cannot be combined')
+        if bounded and (batch_leaves or board_stack):
+            raise ValueError('bounded cannot be combined with batch_leaves or board_stack')
+        if telemetry is not None and (workers or bounded):
+            raise ValueError('telemetry cannot be combined with workers or bounded')
+
         self.states_visited = 0
+        self.telemetry = telemetry
+        self.stats = None
+        self.moves_searched = 0
+        self.max_depth = max_depth
+        self.symmetric = symmetric
+        self.batch_leaves = batch_leaves
+        self.prob_cutoff = prob_cutoff
+        self.max_four_depth = max_four_depth
+        self.tables = get_heuristic_tables() if eval_tables else None
+        self.board_stack = board_stack
+        self.stack = []  # stack[level] is the scratch board of that max node level
+        self.bounded = bounded
+        self.cutoffs = 0  # chance nodes pruned by the bounded search
+
+        self.node_budget = node_budget
+        self.budget = None        # node budget of the current search
+        self.nodes = 0            # chance nodes of the current search
+        self.fallbacks = 0        # static fallbacks of the current search
+        self.total_fallbacks = 0
+
+        if memory_limit is not None:
+            cache_size = min(cache_size, memory_limit // TranspositionTable.ENTRY_BYTES)
+
+        # kept across get_move calls so later moves reuse earlier searches
+        self.cache = TranspositionTable(cache_size) if cache_size else None
+
+        self.workers = workers
+        self.split_tiles = split_tiles
+        self.pool = None
+        self.worker_options = {
+            'cache_size': cache_size,
+            'max_depth': max_depth,
+            'symmetric': symmetric,
+            'batch_leaves': batch_leaves,
+            'prob_cutoff': prob_cutoff,
+            'max_four_depth': max_four_depth,
+            'eval_tables': eval_tables,
+            'board_stack': board_stack,
+            'bounded': bounded,
+            'memory_limit': memory_limit
+        }
+
+        self.time_budget = time_budget
+        self.deadline = None
+        self.completed_depth = 0  # deepest finished iteration of last move
 
     def get_move(self, board):
-        best_move, _ = self.maximize(board)
+        self.moves_searched += 1
+
+        if self.telemetry is not None:
+            return self.get_move_traced(board)
+        return self.search(board)
+
+    def get_move_traced(self, board):
+        stats = MoveStats('expectimax', self.moves_searched)
+        if self.cache is not None:
+            hits, misses = self.cache.hits, self.cache.misses
+
+        self.stats = stats
+        start = timer()
+        try:
+            best_move = self.search(board)
+        finally:
+            self.stats = None
+        stats.total_time = timer() - start
+
+        if self.cache is not None:
+            stats.cache_hits = self.cache.hits - hits
+            stats.cache_misses = self.cache.misses - misses
+        stats.fallbacks = self.fallbacks
+
+        self.telemetry.record(stats)
+        return best_move
+
+    # static evaluation of a leaf
+    def evaluate(self, board, n_empty):
+        if self.tables is None:
+            return eval_board(board, n_empty, self.symmetric)
+        return eval_packed_tables(np.uint64(board.key()), n_empty, self.symmetric, self.tables)
+
+    # static evaluation of an array of packed boards, (N, 4) utilities
+    def evaluate_batch(self, boards):
+        if self.tables is None:
+            return eval_packed_batch(boards, self.symmetric)
+        return eval_packed_tables_batch(boards, self.symmetric, self.tables)
+
+    def start_budget(self, node_budget):
+        self.budget = node_budget
+        self.nodes = 0
+        self.fallbacks = 0
+
+    def search(self, board):
+        self.start_budget(self.node_budget)
+        try:
+            return self.search_budgeted(board)
+        finally:
+            self.total_fallbacks += self.fallbacks
+
+    def search_budgeted(self, board):
+        if self.time_budget is not None:
+            best_move, _ = self.iterative_deepening(board)
+        elif self.workers:
+            best_move, _ = self.maximize_parallel(board)
+        elif self.bounded:
+            best_move, _, _ = self.maximize_bounded(board)
+        else:
+            best_move, _ = self.maximize(board)
         return best_move
 
+    # shut down the worker pool, if one was started
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    # maximize() at the root, repeated with a growing max_depth until the time
+    # budget runs out. Root moves are searched best-first using the previous
+    # iteration's utilities, and the transposition table carries finished
+    # subtrees into the next iteration. Returns the deepest completed result,
+    # or a move from the iteration the timeout cut short if the previous best
+    # finished there and another finished move beat it at the same depth.
+    # get_remaining evaluates a chance node with 6+ empty cells statically
+    # when 2 plies or fewer remain, so on open boards the depth 3 iteration
+    # is the depth 1 search again (answered from the table) and the first
+    # real step is depth 5
+    def iterative_deepening(self, board):
+        moves = board.get_available_moves()
+        moves_boards = []
+
+        for m in moves:
+            m_board = board.clone()
+            m_board.move(m)
+            moves_boards.append((m, m_board))
+
+        order = list(range(len(moves_boards)))
+        best_direction = None
+        max_utility = (float('-inf'),0,0,0)
+
+        max_depth = self.max_depth
+        deadline = timer() + self.time_budget / 1000
+        self.completed_depth = 0
+        depth = 1
+
+        utilities = []
+        try:
+            while moves_boards and depth <= MAX_ID_DEPTH:
+                self.max_depth = depth
+                utilities = [None] * len(moves_boards)
+
+                for i in order:
+                    utilities[i] = self.chance(moves_boards[i][1], 1)
+                    self.states_visited += 1
+
+                # an iteration the node budget cut short only counts if
+                # there is nothing better yet
+                if self.budget is not None and self.nodes > self.budget and self.completed_depth:
+                    break
+
+                # same tie breaking as maximize, independent of search order
+                max_utility = (float('-inf'),0,0,0)
+                for (m, _), utility in zip(moves_boards, utilities):
+                    if utility[0] >= max_utility[0]:
+                        max_utility = utility
+                        best_direction = m
+
+                self.completed_depth = depth
+                order.sort(key=lambda i: (moves[i] != best_direction, -utilities[i][0]))
+                depth += 2
+
+                # the first iteration always finishes so there is a move
+                self.deadline = deadline
+                if timer() > deadline:
+                    break
+        except SearchTimeout:
+            # the previous best is searched first; once it has a utility at
+            # the new depth the finished moves can be compared
+            if utilities and utilities[moves.index(best_direction)] is not None:
+                max_utility = (float('-inf'),0,0,0)
+                for (m, _), utility in zip(moves_boards, utilities):
+                    if utility is not None and utility[0] >= max_utility[0]:
+                        max_utility = utility
+                        best_direction = m
+        finally:
+            self.max_depth = max_depth
+            self.deadline = None
+
+        return best_direction, max_utility
+
+    # maximize() at the root with the subtrees searched by the worker pool;
+    # same utilities and tie breaking as the serial search
+    def maximize_parallel(self, board):
+        if self.pool is None:
+            self.pool = Pool(self.workers, init_search_worker, (self.worker_options,))
+
+        moves = board.get_available_moves()
+        tasks = []
+        nodes = []  # per move: (possible_tiles or None, first task index, utility if static)
+
+        for m in moves:
+            m_board = board.clone()
+            m_board.move(m)
+
+            # the worker's chance() counts the node itself
+            if not self.split_tiles:
+                nodes.append((None, len(tasks), None))
+                tasks.append(['chance', m_board, 1, 1.0, None])
+                continue
+
+            # counted here, so a leaf is evaluated here rather than sent off
+            empty_cells = m_board.get_available_cells()
+            remaining = self.get_remaining(len(empty_cells), 1)
+
+            if remaining == 0 or not empty_cells:
+                utility = self.run_steps(self.chance_remaining_steps(m_board, empty_cells, 1, remaining, 1.0))
+                nodes.append((None, None, utility))
+                continue
+
+            possible_tiles = self.get_possible_tiles(empty_cells, 1)
+            nodes.append((possible_tiles, len(tasks), None))
+
+            for t in possible_tiles:
+                t_board = m_board.clone()
+                t_board.insert_tile(t[0], t[1])
+                tasks.append(['maximize', t_board, 2, t[2], None])
+
+        if self.budget is not None and tasks:
+            for task in tasks:
+                task[4] = max(1, (self.budget - self.nodes) // len(tasks))
+
+        results = self.pool.map(search_worker, [tuple(task) for task in tasks])
+        self.states_visited += sum(r[1] for r in results)
+        self.fallbacks += sum(r[2] for r in results)
+
+        max_utility = (float('-inf'),0,0,0)
+        best_direction = None
+
+        for m, (possible_tiles, first, utility) in zip(moves, nodes):
+            if possible_tiles is not None:
+                utilities = [r[0] for r in results[first:first + len(possible_tiles)]]
+                utility = self.average(possible_tiles, utilities)
+            elif utility is None:
+                utility = results[first][0]
+
+            if utility[0] >= max_utility[0]:
+                max_utility = utility
+                best_direction = m
+
+            self.states_visited += 1
+
+        return best_direction, max_utility
+
     # evaluate board; heauristic function of board state
     def eval_board1(self, board, n_empty): 
         # previous eval function
@@ -130,15 +472,125 @@ class Expectimax():
         return (utility, empty_u, smooth_u, big_t_u)
 
 
-    def maximize(self, board, depth = 0):
+    # The serial search is written as generators, so one search can also run
+    # side by side with others (main_batch.play_lockstep): the leaves
+    # batch_leaves scores together are yielded as a uint64 array of packed
+    # boards and their (N, 4) utilities sent back, and the generator returns
+    # the node's result. maximize() and chance() run a node to its result,
+    # scoring the leaves it yields on the spot
+
+    # prob is the probability of the tile spawns leading to this node
+    def maximize(self, board, depth = 0, prob = 1.0):
+        return self.run_steps(self.maximize_steps(board, depth, prob))
+
+    def chance(self, board, depth = 0, prob = 1.0):
+        return self.run_steps(self.chance_steps(board, depth, prob))
+
+    def run_steps(self, steps):
+        try:
+            leaves = next(steps)
+            while True:
+                leaves = steps.send(self.evaluate_leaves(leaves))
+        except StopIteration as done:
+            return done.value
+
+    # evaluate_batch on the leaves a search yielded
+    def evaluate_leaves(self, leaves):
+        stats = self.stats
+        if stats is None:
+            return self.evaluate_batch(leaves)
+
+        t0 = timer()
+        scores = self.evaluate_batch(leaves)
+        stats.eval_time += timer() - t0
+        stats.leaf_evals += len(leaves)
+        return scores
+
+    def maximize_steps(self, board, depth = 0, prob = 1.0):
+        if self.board_stack:
+            return (yield from self.maximize_stack_steps(board, depth, prob))
+
+        if self.stats is not None:
+            moves_boards = self.moves_boards_traced(board, depth)
+        else:
+            moves_boards = []
+            for m in board.get_available_moves():
+                m_board = board.clone()
+                m_board.move(m)
+                moves_boards.append((m, m_board))
+
+        return (yield from self.maximize_children_steps(moves_boards, depth, prob))
+
+    # (move, board after it) of every move of a max node, filling self.stats
+    def moves_boards_traced(self, board, depth):
+        stats = self.stats
+        stats.max_nodes += 1
+        stats.node(depth)
+
+        t0 = timer()
         moves = board.get_available_moves()
-        moves_boards = []
+        stats.movegen_time += timer() - t0
 
+        moves_boards = []
         for m in moves:
+            t0 = timer()
             m_board = board.clone()
+            t1 = timer()
             m_board.move(m)
+            stats.clone_time += t1 - t0
+            stats.movegen_time += timer() - t1
             moves_boards.append((m, m_board))
 
+        return moves_boards
+
+    # scratch board of a max node level, the stack only grows to the deepest
+    # level searched and is rebuilt when the engine is handed another board type
+    def stack_board(self, board, level):
+        stack = self.stack
+        if stack and type(stack[0]) is not type(board):
+            stack.clear()
+        while len(stack) <= level:
+            stack.append(board.clone())
+        return stack[level]
+
+    # maximize() with every move played into the stack board of its level,
+    # the chance node below spawns its tiles on that board in place
+    def maximize_stack_steps(self, board, depth, prob):
+        stats = self.stats
+        if stats is not None:
+            stats.max_nodes += 1
+            stats.node(depth)
+
+        # max nodes are at even depths and their chance node below reuses the
+        # board in place, so there is one board per max node level
+        child = self.stack_board(board, depth // 2)
+        max_utility = (float('-inf'),0,0,0)
+        best_direction = None
+
+        if stats is not None:
+            t0 = timer()
+        moves = board.get_available_moves()
+        if stats is not None:
+            stats.movegen_time += timer() - t0
+
+        # nothing is cloned, move_into is all of making a child
+        for m in moves:
+            if stats is not None:
+                t0 = timer()
+            board.move_into(m, child)
+            if stats is not None:
+                stats.movegen_time += timer() - t0
+            utility = yield from self.chance_steps(child, depth + 1, prob)
+
+            if utility[0] >= max_utility[0]:
+                max_utility = utility
+                best_direction = m
+
+            self.states_visited += 1
+
+        return best_direction, max_utility
+
+    def maximize_children_steps(self, moves_boards, depth, prob):
         max_utility = (float('-inf'),0,0,0)
         best_direction = None
 
@@ -146,7 +598,7 @@ class Expectimax():
             if DEBUG:
                 print('Testing %s at depth %d:' % (dirs[mb[0]], depth))
                 print_board(mb[1])
-            utility = self.chance(mb[1], depth + 1)
+            utility = yield from self.chance_steps(mb[1], depth + 1, prob)
 
             if utility[0] >= max_utility[0]:
                 max_utility = utility
@@ -156,56 +608,403 @@ class Expectimax():
 
         return best_direction, max_utility
 
-    def chance(self, board, depth = 0):
-        empty_cells = board.get_available_cells()
-        n_empty = len(empty_cells)
+    # plies left to search below a chance node, 0 means evaluate statically.
+    # Called once per chance node, so it also keeps the node budget
+    def get_remaining(self, n_empty, depth, prob = 1.0):
+        remaining = self.max_depth - depth
+
+        if self.budget is not None:
+            self.nodes += 1
+            if self.nodes > self.budget and remaining > 0:
+                self.fallbacks += 1
+                return 0
+
+        if prob < self.prob_cutoff:
+            return 0
 
         #if n_empty >= 7 and depth >= 5:
         #    return self.eval_board(board, n_empty)
 
-        if n_empty >= 6 and depth >= 3:
-            return eval_board(board, n_empty)
+        # static evaluation is a search with nothing remaining, so leaves
+        # are shared no matter how deep in the tree they were reached
+        if (n_empty >= 6 and remaining <= 2) or remaining <= 0:
+            return 0
+        return remaining
+
+    def cache_key(self, board_key, remaining):
+        if self.symmetric:
+            return (canonical(board_key)[0], remaining)
+        return (board_key, remaining)
+
+    def chance_steps(self, board, depth, prob):
+        stats = self.stats
+        if stats is not None:
+            t0 = timer()
+
+        empty_cells = board.get_available_cells()
+        remaining = self.get_remaining(len(empty_cells), depth, prob)
+
+        if stats is not None:
+            stats.movegen_time += timer() - t0
 
-        if n_empty >= 0 and depth >= 5:
-            return eval_board(board, n_empty)
+        return (yield from self.chance_remaining_steps(board, empty_cells, depth, remaining, prob))
+
+    # chance_steps() once remaining is known: get_remaining counts the node
+    # against the budget, so it must run exactly once per node
+    def chance_remaining_steps(self, board, empty_cells, depth, remaining, prob):
+        if self.deadline is not None and timer() > self.deadline:
+            raise SearchTimeout()
+
+        stats = self.stats
+
+        if self.cache is not None:
+            key = self.cache_key(board.key(), remaining)
+            utility = self.cache.get(key)
+            if utility is not None:
+                return utility
+
+        # only nodes actually expanded, cache hits are in the cache counters
+        if stats is not None:
+            stats.chance_nodes += 1
+            stats.node(depth)
+
+        fallbacks = self.fallbacks
+        utility = yield from self.expand_chance_steps(board, empty_cells, depth, remaining, prob)
+
+        # a subtree the node budget left partly static is not the result of
+        # searching remaining plies, later searches must not reuse it
+        if self.cache is not None and self.fallbacks == fallbacks:
+            self.cache.put(key, utility)
+
+        return utility
+
+    def expand_chance_steps(self, board, empty_cells, depth, remaining, prob):
+        n_empty = len(empty_cells)
+
+        if remaining == 0:
+            # a lone leaf costs less to score than to yield
+            stats = self.stats
+            if stats is None:
+                return self.evaluate(board, n_empty)
+
+            t0 = timer()
+            utility = self.evaluate(board, n_empty)
+            stats.eval_time += timer() - t0
+            stats.leaf_evals += 1
+            return utility
 
         if n_empty == 0:
-            _, utility = self.maximize(board, depth + 1)
+            _, utility = yield from self.maximize_steps(board, depth + 1, prob)
             return utility
 
+        possible_tiles = self.get_possible_tiles(empty_cells, depth)
+
+        if self.batch_leaves:
+            utilities = yield from self.maximize_batch_steps(board, possible_tiles, depth + 1, prob)
+        elif self.board_stack:
+            # make / unmake: maximize only reads board, its moves go to the
+            # next stack board
+            utilities = []
+            for t in possible_tiles:
+                board.insert_tile(t[0], t[1])
+                _, utility = yield from self.maximize_steps(board, depth + 1, prob * t[2])
+                board.insert_tile(t[0], 0)
+                utilities.append(utility)
+        else:
+            stats = self.stats
+            utilities = []
+            for t in possible_tiles:
+                if stats is not None:
+                    t0 = timer()
+                t_board = board.clone()
+                if stats is not None:
+                    stats.clone_time += timer() - t0
+                t_board.insert_tile(t[0], t[1])
+                _, utility = yield from self.maximize_steps(t_board, depth + 1, prob * t[2])
+                utilities.append(utility)
+
+        return self.average(possible_tiles, utilities)
+
+    # -------------------- BOUNDED SEARCH -------------------- #
+    # maximize() / chance() with a lower bound alpha: a subtree that cannot
+    # beat alpha is cut off as soon as that is certain. Results are
+    # (utility, exact): exact ones are what the full search returns, cut ones
+    # only promise a true utility[0] <= alpha. Children are searched with
+    # alpha just below the best so far, so ties resolve like maximize()
+    def maximize_bounded(self, board, depth = 0, prob = 1.0, alpha = float('-inf')):
+        moves = board.get_available_moves()
+        best_direction = None
+        best = None
+        cut_bound = float('-inf')  # cut children are <= this
+
+        for m in moves:
+            m_board = board.clone()
+            m_board.move(m)
+
+            a = alpha if best is None else max(alpha, best[0] - bound_slack(best[0]))
+            utility, exact = self.chance_bounded(m_board, depth + 1, prob, a)
+            self.states_visited += 1
+
+            if not exact:
+                cut_bound = max(cut_bound, a)
+            elif best is None or utility[0] >= best[0]:
+                best = utility
+                best_direction = m
+
+        if not moves:
+            return None, (float('-inf'),0,0,0), True
+        if best is None or best[0] < cut_bound:
+            return best_direction, (alpha,0,0,0), False
+        return best_direction, best, True
+
+    def chance_bounded(self, board, depth, prob, alpha):
+        empty_cells = board.get_available_cells()
+        n_empty = len(empty_cells)
+        remaining = self.get_remaining(n_empty, depth, prob)
+
+        if self.cache is not None:
+            key = self.cache_key(board.key(), remaining)
+            utility = self.cache.get(key)
+            if utility is not None:
+                return utility, True
+
+        fallbacks = self.fallbacks
+        if remaining == 0:
+            utility, exact = self.evaluate(board, n_empty), True
+        elif n_empty == 0:
+            _, utility, exact = self.maximize_bounded(board, depth + 1, prob, alpha)
+        else:
+            utility, exact = self.expand_chance_bounded(board, empty_cells, depth, remaining, prob, alpha)
+
+        # cut results and budget degraded subtrees are not cached, see chance
+        if exact and self.cache is not None and self.fallbacks == fallbacks:
+            self.cache.put(key, utility)
+        return utility, exact
+
+    # Star1: children are averaged in the same order as expand_chance_steps,
+    # and before each one the node is cut if even the best utility possible
+    # below it (utility_upper_bound) on every child left cannot reach alpha
+    def expand_chance_bounded(self, board, empty_cells, depth, remaining, prob, alpha):
+        possible_tiles = self.get_possible_tiles(empty_cells, depth)
+
+        # tiles only merge or get added, at most one 4 per ply below
+        upper = utility_upper_bound(packed_tile_sum(board.key()) + 4 * remaining)
+
+        avg_utility = [0, 0, 0, 0]
+        rest = sum(t[2] for t in possible_tiles)
+
+        for t in possible_tiles:
+            if alpha > float('-inf') and avg_utility[0] + rest * upper < alpha:
+                self.cutoffs += 1
+                return (alpha,0,0,0), False
+
+            rest -= t[2]
+            child_alpha = float('-inf')
+            if alpha > float('-inf'):
+                child_alpha = (alpha - avg_utility[0] - rest * upper) / t[2]
+                child_alpha -= bound_slack(child_alpha)
+
+            t_board = board.clone()
+            t_board.insert_tile(t[0], t[1])
+            _, utility, exact = self.maximize_bounded(t_board, depth + 1, prob * t[2], child_alpha)
+
+            if not exact:
+                self.cutoffs += 1
+                return (alpha,0,0,0), False
+
+            for i in range(4):
+                avg_utility[i] += utility[i] * t[2]
+
+        return tuple(avg_utility), True
+
+    # (cell, value, probability) of every tile the computer can spawn
+    def get_possible_tiles(self, empty_cells, depth = 0):
+        n_empty = len(empty_cells)
         possible_tiles = []
 
+        if self.max_four_depth is not None and depth > self.max_four_depth:
+            for empty_cell in empty_cells:
+                possible_tiles.append((empty_cell, 2, 1 / n_empty))
+            return possible_tiles
+
         chance_2 = (.9 * (1 / n_empty))
         chance_4 = (.1 * (1 / n_empty))
-        
+
         for empty_cell in empty_cells:
             possible_tiles.append((empty_cell, 2, chance_2))
             possible_tiles.append((empty_cell, 4, chance_4))
 
+        return possible_tiles
+
+    # expected utility over the spawned tiles
+    def average(self, possible_tiles, utilities):
         avg_utility = [0, 0, 0, 0]
 
+        for t, utility in zip(possible_tiles, utilities):
+            for i in range(4):
+                avg_utility[i] += utility[i] * t[2]
+
+        return tuple(avg_utility)
+
+    # maximize() for every tile insertion of a chance node at once, so the
+    # leaves below them are scored together by one evaluate_batch
+    def maximize_batch_steps(self, board, possible_tiles, depth, prob):
+        stats = self.stats
+        tiles_moves = []
+        children = []
+        probs = []
+
         for t in possible_tiles:
+            if stats is not None:
+                t0 = timer()
             t_board = board.clone()
+            if stats is not None:
+                stats.clone_time += timer() - t0
             t_board.insert_tile(t[0], t[1])
-            _, utility = self.maximize(t_board, depth + 1)
-
-            for i in range(4):
-                avg_utility[i] += utility[i] # * t[2]
 
-        for i in range(4):
-            avg_utility[i] /= len(possible_tiles)
-
-        return tuple(avg_utility)
+            if stats is None:
+                moves = t_board.get_available_moves()
+                for m in moves:
+                    m_board = t_board.clone()
+                    m_board.move(m)
+                    children.append(m_board)
+                    probs.append(prob * t[2])
+            else:
+                # counts the max node as well
+                moves_boards = self.moves_boards_traced(t_board, depth)
+                moves = [mb[0] for mb in moves_boards]
+                children.extend(mb[1] for mb in moves_boards)
+                probs.extend([prob * t[2]] * len(moves))
+
+            tiles_moves.append(moves)
+
+        child_utilities = yield from self.chance_batch_steps(children, depth + 1, probs)
+
+        utilities = []
+        c = 0
+        for moves in tiles_moves:
+            max_utility = (float('-inf'),0,0,0)
+
+            for m in moves:
+                utility = child_utilities[c]
+                c += 1
+
+                if utility[0] >= max_utility[0]:
+                    max_utility = utility
+
+                self.states_visited += 1
+
+            utilities.append(max_utility)
+
+        return utilities
+
+    # chance() for a list of boards at the same depth, their leaves are
+    # yielded together
+    def chance_batch_steps(self, boards, depth, probs):
+        utilities = [None] * len(boards)
+        leaves = []
+        leaf_keys = []
+
+        for i, b in enumerate(boards):
+            board_key = b.key()
+            remaining = self.get_remaining(count_empty(np.uint64(board_key)), depth, probs[i])
+
+            if remaining != 0:
+                utilities[i] = yield from self.chance_remaining_steps(b, b.get_available_cells(), depth, remaining, probs[i])
+                continue
+
+            if self.cache is not None:
+                key = self.cache_key(board_key, 0)
+                utility = self.cache.get(key)
+                if utility is not None:
+                    utilities[i] = utility
+                    continue
+
+            if self.stats is not None:
+                self.stats.chance_nodes += 1
+                self.stats.node(depth)
+
+            leaves.append(i)
+            leaf_keys.append(board_key)
+
+        if leaves:
+            scores = yield np.array(leaf_keys, dtype=np.uint64)
+
+            for i, board_key, row in zip(leaves, leaf_keys, scores):
+                utility = tuple(row)
+                utilities[i] = utility
+
+                if self.cache is not None:
+                    self.cache.put(self.cache_key(board_key, 0), utility)
+
+        return utilities
+
+    # search() of the serial search as a generator (see maximize_steps), for
+    # main_batch.play_lockstep. The move is the generator's return value
+    def search_steps(self, board):
+        self.moves_searched += 1
+        self.start_budget(self.node_budget)
+        try:
+            best_move, _ = yield from self.maximize_steps(board)
+        finally:
+            self.total_fallbacks += self.fallbacks
+        return best_move
 
 
 # -------------------- MONTE CARLO -------------------- #
 class MonteCarlo:
-    def __init__(self):
+    # vectorized = True plays all runs in lockstep with rollouts.rollout_batch
+    # (random tiles are spawned between moves), seed makes those repeatable
+    # telemetry is a telemetry.TelemetrySink getting a MoveStats per move
+    # allocation = 'racing' spends up to num_runs adaptively instead of
+    # uniformly: rounds of min_runs, 2 * min_runs, ... rollouts per surviving
+    # move, after each of which a move is dropped once its mean is
+    # confidence_z standard errors clear below the best move's. The search
+    # stops when one move is left; close moves stay in to the end
+    def __init__(self, vectorized = False, num_runs = 1000, depth = 3, seed = None, telemetry = None,
+                 allocation = 'uniform', min_runs = 16, confidence_z = 2.0):
         self.states_visited = 0
+        self.telemetry = telemetry
+        self.stats = None
+        self.moves_searched = 0
+        self.vectorized = vectorized
+        self.num_runs = num_runs
+        self.depth = depth
+        self.rng = np.random.default_rng(seed)
+        self.allocation = allocation
+        self.min_runs = min_runs
+        self.confidence_z = confidence_z
+        self.runs_used = 0  # rollouts spent on the last move
 
     def get_move(self, board):
+        self.moves_searched += 1
+
+        if self.telemetry is None:
+            return self.search(board)
+
+        stats = MoveStats('montecarlo', self.moves_searched)
+        self.stats = stats
+        start = timer()
+        try:
+            best_move = self.search(board)
+        finally:
+            self.stats = None
+        stats.total_time = timer() - start
+        stats.rollouts = self.runs_used
+
+        self.telemetry.record(stats)
+        return best_move
+
+    def search(self, board):
+        if self.allocation == 'racing':
+            return self.get_move_racing(board)
+
+        self.runs_used = self.num_runs
+        if self.vectorized:
+            return self.get_move_vectorized(board)
+
         moves = board.get_available_moves()
-        num_runs = 1000
+        num_runs = self.num_runs
         boards = []
 
         runs_sum = {}
@@ -243,16 +1042,104 @@ class MonteCarlo:
         # print(runs_sum)
         return best_move
 
+    def get_move_vectorized(self, board):
+        moves = board.get_available_moves()
+        if not moves:
+            return None
+
+        first = self.rng.integers(len(moves), size=self.num_runs)
+        first_moves = np.array(moves)[first]
+        boards = np.full(self.num_runs, board.key(), dtype=np.uint64)
+
+        t0 = timer()
+        final = rollout_batch(boards, first_moves, self.depth, self.rng)
+        t1 = timer()
+        scores = eval_packed_batch(final, False)[:, 0]
+        self.states_visited += self.num_runs * (self.depth + 1)
+
+        if self.stats is not None:
+            self.stats.movegen_time += t1 - t0
+            self.stats.eval_time += timer() - t1
+            self.stats.leaf_evals += self.num_runs
+            for d in range(self.depth + 1):
+                self.stats.nodes_by_depth[d + 1] = self.num_runs
+
+        # get best score & move
+        runs_sum = np.bincount(first, weights=scores, minlength=len(moves))
+        runs_ttl = np.bincount(first, minlength=len(moves))
+        avg = np.where(runs_ttl > 0, runs_sum / np.maximum(runs_ttl, 1), float('-inf'))
+
+        return moves[int(np.argmax(avg))]
+
+    # n rollout values of every move in arms, {move: array}
+    def sample_moves(self, board, arms, n):
+        if not self.vectorized:
+            return {m: np.array([self.run_board(board.clone(), m) for _ in range(n)]) for m in arms}
+
+        first_moves = np.repeat(np.array(arms), n)
+        boards = np.full(len(first_moves), board.key(), dtype=np.uint64)
+
+        t0 = timer()
+        final = rollout_batch(boards, first_moves, self.depth, self.rng)
+        t1 = timer()
+        scores = eval_packed_batch(final, False)[:, 0]
+        self.states_visited += len(first_moves) * (self.depth + 1)
+
+        if self.stats is not None:
+            self.stats.movegen_time += t1 - t0
+            self.stats.eval_time += timer() - t1
+            self.stats.leaf_evals += len(first_moves)
+
+        return {m: scores[i * n:(i + 1) * n] for i, m in enumerate(arms)}
+
+    def get_move_racing(self, board):
+        moves = board.get_available_moves()
+        self.runs_used = 0
+        if len(moves) <= 1:
+            return moves[0] if moves else None
+
+        values = {m: np.empty(0) for m in moves}
+        arms = list(moves)
+        n = self.min_runs
+
+        while len(arms) > 1 and self.runs_used < self.num_runs:
+            n = min(n, (self.num_runs - self.runs_used) // len(arms))
+            if n == 0:
+                break
+            for m, v in self.sample_moves(board, arms, n).items():
+                values[m] = np.concatenate([values[m], v])
+            self.runs_used += n * len(arms)
+            n *= 2
+
+            z = self.confidence_z
+            means = {m: values[m].mean() for m in arms}
+            bound = {m: z * values[m].std() / math.sqrt(len(values[m])) for m in arms}
+            best = max(arms, key=lambda m: means[m])
+            arms = [m for m in arms if means[m] + bound[m] >= means[best] - bound[best]]
+
+        means = {m: values[m].mean() for m in arms}
+        return max(arms, key=lambda m: means[m])
 
     def run_board(self, board, move, depth = 0):
         board.move(move)
+        self.states_visited += 1
         empty_cells = board.get_available_cells()
         n_empty = len(empty_cells)
 
+        stats = self.stats
+        if stats is not None:
+            stats.node(depth + 1)
 
         # base case
-        if n_empty == 0 or depth >= 3:
-            return eval_board(board, n_empty)[0]
+        if n_empty == 0 or depth >= self.depth:
+            if stats is None:
+                return eval_board(board, n_empty)[0]
+
+            t0 = timer()
+            utility = eval_board(board, n_empty)[0]
+            stats.eval_time += timer() - t0
+            stats.leaf_evals += 1
+            return utility
 
 
         # random tile generated - we are not checking probabilities anymore
@@ -279,4 +1166,276 @@ class MonteCarlo:
             return None
         else:
             board.insert_tile(pos, value)
-            return pos
\ No newline at end of file
+            return pos
+
+
+# -------------------- MCTS -------------------- #
+DECISION, CHANCE = 0, 1
+
+# search tree nodes stored column-wise, node n is index n of every array.
+# The children of a node are a linked list, first_child[n] then sibling[c]
+class NodePool:
+    ARRAYS = ['key', 'kind', 'edge', 'visits', 'total', 'first_child', 'sibling', 'expanded']
+
+    def __init__(self, capacity = 1024):
+        self.size = 0
+        self.key = np.zeros(capacity, dtype=np.uint64)   # packed board, after the move for chance nodes
+        self.kind = np.zeros(capacity, dtype=np.int8)    # DECISION or CHANCE
+        self.edge = np.zeros(capacity, dtype=np.int8)    # move into a chance node, 2 * cell + (tile == 4) into a decision node
+        self.visits = np.zeros(capacity, dtype=np.int64)
+        self.total = np.zeros(capacity)                  # sum of the values backed up through the node
+        self.first_child = np.full(capacity, -1, dtype=np.int32)
+        self.sibling = np.full(capacity, -1, dtype=np.int32)
+        self.expanded = np.zeros(capacity, dtype=np.bool_)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key, kind, edge, parent):
+        if self.size == len(self.key):
+            for name in self.ARRAYS:
+                a = getattr(self, name)
+                grown = np.full(2 * len(a), -1 if name in ('first_child', 'sibling') else 0, dtype=a.dtype)
+                grown[:len(a)] = a
+                setattr(self, name, grown)
+
+        n = self.size
+        self.size += 1
+        self.key[n] = key
+        self.kind[n] = kind
+        self.edge[n] = edge
+
+        if parent >= 0:
+            self.sibling[n] = self.first_child[parent]
+            self.first_child[parent] = n
+        return n
+
+    def children(self, n):
+        c = self.first_child[n]
+        while c != -1:
+            yield c
+            c = self.sibling[c]
+
+    # a new pool of only the subtree below root, which becomes node 0
+    def subtree(self, root):
+        order = [root]
+        i = 0
+        while i < len(order):
+            order.extend(self.children(order[i]))
+            i += 1
+        order = np.array(order)
+
+        new_index = np.full(self.size + 1, -1, dtype=np.int32)  # [-1] stays -1
+        new_index[order] = np.arange(len(order))
+
+        pool = NodePool(0)
+        for name in self.ARRAYS:
+            setattr(pool, name, getattr(self, name)[order])
+        pool.first_child = new_index[pool.first_child]
+        pool.sibling = new_index[pool.sibling]
+        pool.size = len(order)
+        return pool
+
+class MCTS:
+    # UCT search over decision nodes (player to move) and chance nodes (tile
+    # spawn after a move), on packed boards (see bit_board) whatever the
+    # board type. Each iteration walks down by UCB1 at decision nodes and by
+    # sampling a spawn at chance nodes, adds one node, plays rollout_depth
+    # random moves from it and backs eval_packed's utility up the path.
+    #
+    # num_rollouts iterations per get_move, or with time_budget (ms) as many
+    # as fit. exploration is the UCB1 constant on values scaled to [0, 1] by
+    # the lowest and highest values seen. reuse = True keeps the subtree of
+    # the position reached by the next get_move instead of starting over
+    def __init__(self, num_rollouts = 1000, time_budget = None, rollout_depth = 0, exploration = 1.0,
+                 reuse = True, seed = None, telemetry = None):
+        self.states_visited = 0
+        self.telemetry = telemetry
+        self.stats = None
+        self.moves_searched = 0
+        self.num_rollouts = num_rollouts
+        self.time_budget = time_budget
+        self.rollout_depth = rollout_depth
+        self.exploration = exploration
+        self.reuse = reuse
+        self.rng = Random(seed)
+
+        self.pool = None
+        self.v_min = float('inf')
+        self.v_max = float('-inf')
+        self.reused_visits = 0  # root visits carried over into the last search
+        self.rollouts = 0       # iterations run by the last search
+
+    def get_move(self, board):
+        self.moves_searched += 1
+
+        if self.telemetry is None:
+            return self.search(board)
+
+        stats = MoveStats('mcts', self.moves_searched)
+        self.stats = stats
+        start = timer()
+        try:
+            best_move = self.search(board)
+        finally:
+            self.stats = None
+        stats.total_time = timer() - start
+        stats.rollouts = self.rollouts
+
+        self.telemetry.record(stats)
+        return best_move
+
+    def search(self, board):
+        self.set_root(board.key())
+        pool = self.pool
+        if not pool.expanded[0]:
+            self.expand(0)
+        if pool.first_child[0] == -1:
+            return None
+
+        n = 0
+        if self.time_budget is None:
+            while n < self.num_rollouts:
+                self.iterate()
+                n += 1
+        else:
+            deadline = timer() + self.time_budget / 1000
+            while n == 0 or timer() < deadline:
+                self.iterate()
+                n += 1
+        self.rollouts = n
+
+        # most visited move, the first one on ties
+        pool = self.pool
+        best_move = None
+        best_visits = -1
+        for c in pool.children(0):
+            if pool.visits[c] > best_visits or (pool.visits[c] == best_visits and pool.edge[c] < best_move):
+                best_visits = pool.visits[c]
+                best_move = int(pool.edge[c])
+        return best_move
+
+    # root the tree at key, reusing a grandchild of the old root if the game
+    # went there (our move, then the tile spawned)
+    def set_root(self, key):
+        pool = self.pool
+        self.reused_visits = 0
+
+        if self.reuse and pool is not None:
+            for c in pool.children(0):
+                for d in pool.children(c):
+                    if int(pool.key[d]) == key:
+                        self.pool = pool.subtree(d)
+                        self.reused_visits = int(self.pool.visits[0])
+                        return
+
+        self.pool = NodePool()
+        self.pool.add(key, DECISION, -1, -1)
+
+    # a chance node per legal move of decision node n
+    def expand(self, n):
+        pool = self.pool
+        b = int(pool.key[n])
+        mask = move_mask_packed(b)
+        for m in (UP, DOWN, LEFT, RIGHT):
+            if mask >> m & 1:
+                pool.add(move_packed(b, m), CHANCE, m, n)
+        pool.expanded[n] = True
+
+    # one selection / expansion / rollout / backup pass from the root
+    def iterate(self):
+        pool = self.pool
+        path = [0]
+        n = 0
+
+        while True:
+            if pool.kind[n] == DECISION:
+                if not pool.expanded[n]:
+                    if pool.visits[n] == 0:
+                        break
+                    self.expand(n)
+                if pool.first_child[n] == -1:
+                    break
+                n = self.select(n)
+            else:
+                n = self.spawn(n)
+                pool = self.pool  # spawn may have grown the arrays
+            path.append(n)
+
+        stats = self.stats
+        if stats is not None:
+            stats.node(len(path) - 1)
+            t0 = timer()
+        value = self.rollout(int(pool.key[n]))
+        if stats is not None:
+            stats.eval_time += timer() - t0
+            stats.leaf_evals += 1
+
+        for p in path:
+            pool.visits[p] += 1
+            pool.total[p] += value
+        self.states_visited += len(path)
+
+    # UCB1 child of decision node n, unvisited children first
+    def select(self, n):
+        pool = self.pool
+        log_n = math.log(max(pool.visits[n], 1))
+        span = self.v_max - self.v_min if self.v_max > self.v_min else 1.0
+
+        best = -1
+        best_u = float('-inf')
+        for c in pool.children(n):
+            v = pool.visits[c]
+            if v == 0:
+                return c
+
+            u = (pool.total[c] / v - self.v_min) / span + self.exploration * math.sqrt(log_n / v)
+            if u > best_u:
+                best_u = u
+                best = c
+        return best
+
+    # decision child of chance node n for a randomly spawned tile, added to
+    # the tree the first time that spawn comes up
+    def spawn(self, n):
+        pool = self.pool
+        b = int(pool.key[n])
+        cell, e = self.random_tile(b)
+        edge = 2 * cell + (e == 2)
+
+        for c in pool.children(n):
+            if pool.edge[c] == edge:
+                return c
+        return pool.add(b | (e << (4 * cell)), DECISION, edge, n)
+
+    # (cell, exponent) of a random spawn, 2 (90%) or 4 (10%) on an empty cell
+    def random_tile(self, b):
+        mask = empty_mask_packed(b)
+        k = self.rng.randrange(mask.bit_count())
+        for _ in range(k):
+            mask &= mask - 1
+        cell = (mask & -mask).bit_length() - 1
+        return cell, 1 if self.rng.random() < 0.9 else 2
+
+    # utility of board b after rollout_depth random moves and spawns, a
+    # finished game is worth 0
+    def rollout(self, b):
+        for _ in range(self.rollout_depth):
+            mask = move_mask_packed(b)
+            if not mask:
+                return 0.0
+
+            moves = [m for m in (UP, DOWN, LEFT, RIGHT) if mask >> m & 1]
+            b = move_packed(b, moves[self.rng.randrange(len(moves))])
+            cell, e = self.random_tile(b)
+            b |= e << (4 * cell)
+            self.states_visited += 1
+
+        n_empty = empty_mask_packed(b).bit_count()
+        if n_empty == 0 and not move_mask_packed(b):
+            return 0.0
+
+        value = eval_packed(np.uint64(b), n_empty, False)[0]
+        self.v_min = min(self.v_min, value)
+        self.v_max = max(self.v_max, value)
+        return value
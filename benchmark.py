@@ -0,0 +1,201 @@
+import json
+import random
+import numpy as np
+from sys import argv
+from timeit import default_timer as timer
+from game_board import GameBoard
+from bit_board import BitBoard, packed_to_grid, LEFT
+from exp_board import ExpBoard
+from ai import Expectimax, MonteCarlo, MCTS, eval_board
+
+# reproducible speed benchmark of the search engines
+#
+#   python3 benchmark.py                 # run, write bench_results.json
+#   python3 benchmark.py save-baseline   # run, also store bench_baseline.json
+#   python3 benchmark.py record          # re-record bench_positions.json
+#
+# positions come from bench_positions.json (packed boards, see bit_board),
+# decisions are compared against the moves stored in bench_baseline.json
+
+CORPUS_FILE = 'bench_positions.json'
+BASELINE_FILE = 'bench_baseline.json'
+RESULTS_FILE = 'bench_results.json'
+
+SEED = 2048
+
+# move numbers at which a recorded game is sampled, by game phase
+PHASES = {
+    'early': [5, 20, 40],
+    'mid': [120, 200, 280],
+    'late': [450, 600, 750]
+}
+
+ENGINES = {
+    'expectimax': lambda seed: Expectimax(),
+    'montecarlo': lambda seed: MonteCarlo(seed=seed),
+    'mcts': lambda seed: MCTS(seed=seed)
+}
+
+BOARDS = {
+    'GameBoard': lambda key: GameBoard(packed_to_grid(key)),
+    'ExpBoard': lambda key: ExpBoard.from_grid(packed_to_grid(key)),
+    'BitBoard': lambda key: BitBoard(key)
+}
+
+
+def insert_random_tile(board, rng):
+    value = 2 if rng.randint(0, 99) < 100 * 0.9 else 4
+    cells = board.get_available_cells()
+    if cells:
+        board.insert_tile(cells[rng.randint(0, len(cells) - 1)], value)
+
+# play seeded Expectimax games and keep the positions at the PHASES moves
+def record_corpus(seed = SEED, games = 2):
+    corpus = {phase: [] for phase in PHASES}
+    wanted = {n: phase for phase, moves in PHASES.items() for n in moves}
+
+    for g in range(games):
+        rng = random.Random(seed + g)
+        board = BitBoard()
+        ai = Expectimax()
+        insert_random_tile(board, rng)
+        insert_random_tile(board, rng)
+
+        moves = 0
+        while moves < max(wanted):
+            if moves in wanted:
+                corpus[wanted[moves]].append(board.key())
+
+            move = ai.get_move(board)
+            if move is None:
+                break
+            board.move(move)
+            insert_random_tile(board, rng)
+            moves += 1
+
+    return corpus
+
+def percentiles(times):
+    times = np.array(times) * 1000
+    return {
+        'p50_ms': float(np.percentile(times, 50)),
+        'p90_ms': float(np.percentile(times, 90)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'max_ms': float(np.max(times))
+    }
+
+# run an engine over the whole corpus, fresh engine per position so the
+# transposition table of one position does not speed up the next
+def bench_engine(name, corpus, board_name, seed = SEED):
+    make_board = BOARDS[board_name]
+    times = []
+    states = 0
+    decisions = {}
+
+    for phase, keys in corpus.items():
+        decisions[phase] = []
+
+        for n, key in enumerate(keys):
+            random.seed(seed + n)
+            ai = ENGINES[name](seed + n)
+            board = make_board(key)
+
+            start = timer()
+            move = ai.get_move(board)
+            times.append(timer() - start)
+
+            states += ai.states_visited
+            decisions[phase].append(move)
+
+    result = percentiles(times)
+    result['states'] = states
+    result['states_per_sec'] = states / sum(times)
+    result['decisions'] = decisions
+    return result
+
+def time_op(op, n):
+    start = timer()
+    for _ in range(n):
+        op()
+    return (timer() - start) / n * 1e6
+
+# per call microseconds of the board primitives and eval_board
+def bench_micro(corpus, board_name, n = 2000):
+    make_board = BOARDS[board_name]
+    boards = [make_board(key) for keys in corpus.values() for key in keys]
+    result = {}
+
+    def over_boards(f):
+        return lambda: [f(b) for b in boards]
+
+    per = len(boards)
+    result['move_us'] = time_op(over_boards(lambda b: b.clone().move(LEFT)), n // per) / per
+    result['clone_us'] = time_op(over_boards(lambda b: b.clone()), n // per) / per
+    result['get_available_moves_us'] = time_op(over_boards(lambda b: b.get_available_moves()), n // per) / per
+    result['eval_board_us'] = time_op(over_boards(lambda b: eval_board(b, len(b.get_available_cells()))), n // per) / per
+    return result
+
+# fraction of decisions equal to the baseline's, per engine / board
+def agreement(results, baseline):
+    out = {}
+    for run, result in results['engines'].items():
+        if run not in baseline.get('engines', {}):
+            continue
+
+        same = total = 0
+        base = baseline['engines'][run]['decisions']
+        for phase, moves in result['decisions'].items():
+            for a, b in zip(moves, base.get(phase, [])):
+                same += a == b
+                total += 1
+        out[run] = same / total if total else None
+    return out
+
+def run(corpus, seed = SEED):
+    results = {'seed': seed, 'engines': {}, 'micro': {}}
+
+    for board_name in BOARDS:
+        # first calls for Numba to compile fast versions
+        bench_engine('expectimax', {'warmup': corpus['early'][:1]}, board_name, seed)
+        results['micro'][board_name] = bench_micro(corpus, board_name)
+
+        for name in ENGINES:
+            results['engines'][name + '/' + board_name] = bench_engine(name, corpus, board_name, seed)
+
+    return results
+
+def main():
+    command = argv[1] if len(argv) > 1 else 'run'
+
+    if command == 'record':
+        with open(CORPUS_FILE, 'w') as f:
+            json.dump(record_corpus(), f, indent=2)
+        return
+
+    with open(CORPUS_FILE) as f:
+        corpus = json.load(f)
+
+    results = run(corpus)
+
+    try:
+        with open(BASELINE_FILE) as f:
+            results['agreement'] = agreement(results, json.load(f))
+    except FileNotFoundError:
+        results['agreement'] = {}
+
+    with open(RESULTS_FILE, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if command == 'save-baseline':
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    for run_name, r in results['engines'].items():
+        print('%-22s %10.0f states/s  p50 %8.2f ms  p99 %8.2f ms  agreement %s' % (
+            run_name, r['states_per_sec'], r['p50_ms'], r['p99_ms'], results['agreement'].get(run_name)))
+    for board_name, r in results['micro'].items():
+        print('%-22s ' % board_name + '  '.join('%s %.2f' % kv for kv in r.items()))
+
+
+if __name__ == '__main__':
+    main()
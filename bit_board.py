@@ -0,0 +1,301 @@
+import os
+import numpy as np
+from helpers import load_table, table_version
+
+# board is a 64-bit int: cell (i, j) holds its log2 exponent (0 = empty)
+# in the nibble at bit 4 * (4 * i + j), so row i is the 16 bits at 16 * i
+# and column 0 is the low nibble of every row
+
+dirs = [UP, DOWN, LEFT, RIGHT] = range(4)
+
+ROW_MASK = 0xFFFF
+COL_MASK = 0x000F000F000F000F
+
+# unpack 16-bit row into its 4 exponents, column 0 first
+def unpack_row(row):
+    return [(row >> (4 * j)) & 0xF for j in range(4)]
+
+def pack_row(cells):
+    row = 0
+    for j in range(4):
+        row |= cells[j] << (4 * j)
+    return row
+
+def reverse_row(row):
+    return ((row >> 12) & 0xF) | ((row >> 4) & 0xF0) | ((row << 4) & 0xF00) | ((row << 12) & 0xF000)
+
+# slide + merge one row to the left, same rules as game_board.merge:
+# justify, merge equal pairs left to right, justify again
+def slide_row_left(row):
+    cells = [c for c in unpack_row(row) if c != 0]
+    out = []
+    score = 0
+    i = 0
+    while i < len(cells):
+        if i + 1 < len(cells) and cells[i] == cells[i + 1]:
+            # exponents saturate at 15 (32768) so a row still fits in 16 bits
+            merged = min(cells[i] + 1, 15)
+            out.append(merged)
+            score += 1 << merged
+            i += 2
+        else:
+            out.append(cells[i])
+            i += 1
+    out += [0] * (4 - len(out))
+    return pack_row(out), score
+
+# rows of the table: left slide, right slide, merge score of a left slide
+def build_row_tables():
+    tables = np.zeros((3, 65536), dtype=np.uint32)
+
+    for row in range(65536):
+        left, score = slide_row_left(row)
+        tables[0, row] = left
+        tables[2, row] = score
+        tables[1, reverse_row(row)] = reverse_row(left)
+
+    return tables
+
+ROW_TABLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'row_tables.npy')
+
+# bump when build_row_tables changes, so saved tables are rebuilt
+ROW_TABLES_VERSION = table_version(1)
+
+ROW_LEFT, ROW_RIGHT, ROW_SCORE = load_table(ROW_TABLES_FILE, build_row_tables,
+                                            ROW_TABLES_VERSION, (3, 65536), np.uint32)
+
+# python lists index faster than numpy arrays from plain python code
+_row_left = ROW_LEFT.tolist()
+_row_right = ROW_RIGHT.tolist()
+_row_score = ROW_SCORE.tolist()
+
+# swap rows and columns of a packed board
+def transpose(b):
+    a1 = b & 0xF0F00F0FF0F00F0F
+    a2 = b & 0x0000F0F00000F0F0
+    a3 = b & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+# mirror columns (left <-> right)
+def flip_h(b):
+    return (((b & 0x000F000F000F000F) << 12)
+            | ((b & 0x00F000F000F000F0) << 4)
+            | ((b >> 4) & 0x00F000F000F000F0)
+            | ((b >> 12) & 0x000F000F000F000F))
+
+# mirror rows (top <-> bottom)
+def flip_v(b):
+    return (((b & 0xFFFF) << 48)
+            | ((b & 0xFFFF0000) << 16)
+            | ((b >> 16) & 0xFFFF0000)
+            | ((b >> 48) & 0xFFFF))
+
+# the 8 symmetries of the square: bit 0 flips columns, bit 1 flips rows,
+# bit 2 transposes, applied in that order
+def symmetry(b, sym):
+    if sym & 1:
+        b = flip_h(b)
+    if sym & 2:
+        b = flip_v(b)
+    if sym & 4:
+        b = transpose(b)
+    return b
+
+# minimal representative of the 8 symmetric boards and the symmetry giving it
+def canonical(b):
+    best, best_sym = b, 0
+    for sym in range(1, 8):
+        t = symmetry(b, sym)
+        if t < best:
+            best, best_sym = t, sym
+    return best, best_sym
+
+_flip_h_move = [UP, DOWN, RIGHT, LEFT]
+_flip_v_move = [DOWN, UP, LEFT, RIGHT]
+_transpose_move = [LEFT, RIGHT, UP, DOWN]
+
+# move on the original board -> same move on symmetry(board, sym)
+def map_move(move, sym):
+    if sym & 1:
+        move = _flip_h_move[move]
+    if sym & 2:
+        move = _flip_v_move[move]
+    if sym & 4:
+        move = _transpose_move[move]
+    return move
+
+# move on symmetry(board, sym) -> same move on the original board
+def unmap_move(move, sym):
+    if sym & 4:
+        move = _transpose_move[move]
+    if sym & 2:
+        move = _flip_v_move[move]
+    if sym & 1:
+        move = _flip_h_move[move]
+    return move
+
+def apply_row_table(b, table):
+    return (table[b & ROW_MASK]
+            | (table[(b >> 16) & ROW_MASK] << 16)
+            | (table[(b >> 32) & ROW_MASK] << 32)
+            | (table[(b >> 48) & ROW_MASK] << 48))
+
+def move_packed(b, dir):
+    if dir == LEFT:
+        return apply_row_table(b, _row_left)
+    if dir == RIGHT:
+        return apply_row_table(b, _row_right)
+    if dir == UP:
+        return transpose(apply_row_table(transpose(b), _row_left))
+    if dir == DOWN:
+        return transpose(apply_row_table(transpose(b), _row_right))
+    return b
+
+# merge score of moving dir. Equal tiles pair up the same way whichever end
+# a row is merged from, so right moves use the left move scores
+def move_score_packed(b, dir):
+    if dir == UP or dir == DOWN:
+        b = transpose(b)
+    return (_row_score[b & ROW_MASK] + _row_score[(b >> 16) & ROW_MASK]
+            + _row_score[(b >> 32) & ROW_MASK] + _row_score[(b >> 48) & ROW_MASK])
+
+# 4-bit mask of legal moves, bit d set when direction d changes the board
+def move_mask_packed(b):
+    mask = 0
+    if apply_row_table(b, _row_left) != b:
+        mask |= 1 << LEFT
+    if apply_row_table(b, _row_right) != b:
+        mask |= 1 << RIGHT
+    t = transpose(b)
+    if apply_row_table(t, _row_left) != t:
+        mask |= 1 << UP
+    if apply_row_table(t, _row_right) != t:
+        mask |= 1 << DOWN
+    return mask
+
+# 16-bit mask of empty cells, bit 4 * i + j set when (i, j) is empty
+def empty_mask_packed(b):
+    # fold every nibble onto its low bit, then pick out the zero nibbles
+    x = b | (b >> 1)
+    x |= x >> 2
+    x = ~x & 0x1111111111111111
+
+    mask = 0
+    k = 0
+    while x:
+        if x & 1:
+            mask |= 1 << k
+        x >>= 4
+        k += 1
+    return mask
+
+# cells of a 16-bit empty mask, in row-major order
+def mask_to_cells(mask):
+    cells = []
+    while mask:
+        low = mask & -mask
+        k = low.bit_length() - 1
+        cells.append((k >> 2, k & 3))
+        mask ^= low
+    return cells
+
+def grid_to_packed(grid):
+    b = 0
+    for i in range(4):
+        for j in range(4):
+            v = int(grid[i][j])
+            if v != 0:
+                b |= (v.bit_length() - 1) << (4 * (4 * i + j))
+    return b
+
+def packed_to_grid(b):
+    grid = np.zeros((4, 4))
+    for i in range(4):
+        for j in range(4):
+            e = (b >> (4 * (4 * i + j))) & 0xF
+            if e != 0:
+                grid[i][j] = 1 << e
+    return grid
+
+class BitBoard:
+    def __init__(self, board=0, score=0):
+        self.board = board
+        self.score = score  # sum of the tiles made by merges
+
+    @classmethod
+    def from_grid(cls, grid):
+        return cls(grid_to_packed(grid))
+
+    # tile values as a 4x4 float array, same layout as GameBoard.grid
+    @property
+    def grid(self):
+        return packed_to_grid(self.board)
+
+    def clone(self):
+        return BitBoard(self.board, self.score)
+
+    def insert_tile(self, pos, value):
+        shift = 4 * (4 * pos[0] + pos[1])
+        e = int(value).bit_length() - 1 if value else 0
+        self.board = (self.board & ~(0xF << shift)) | (e << shift)
+
+    # hashable key of the position, used by the search caches
+    def key(self):
+        return self.board
+
+    # (key, sym) of the minimal symmetric position, see bit_board.canonical
+    def canonical(self):
+        return canonical(self.board)
+
+    def get_available_cells(self):
+        return mask_to_cells(self.get_empty_mask())
+
+    def get_empty_mask(self):
+        return empty_mask_packed(self.board)
+
+    def count_empty(self):
+        return self.get_empty_mask().bit_count()
+
+    def get_move_mask(self):
+        return move_mask_packed(self.board)
+
+    def get_max_tile(self):
+        b = self.board
+        e = 0
+        while b:
+            e = max(e, b & 0xF)
+            b >>= 4
+        return 1 << e if e else 0
+
+    def move(self, dir, get_avail_call = False):
+        new = move_packed(self.board, dir)
+        changed = new != self.board
+        if changed:
+            self.score += move_score_packed(self.board, dir)
+        self.board = new
+
+        if get_avail_call:
+            return changed
+        else:
+            return None
+
+    # play dir into the board out, returns (changed, score), see GameBoard
+    def move_into(self, dir, out):
+        new = move_packed(self.board, dir)
+        changed = new != self.board
+        score = move_score_packed(self.board, dir)
+        out.board = new
+        out.score = self.score + score
+        return changed, score
+
+    def get_available_moves(self, dirs = dirs):
+        mask = self.get_move_mask()
+        return [x for x in dirs if mask >> x & 1]
+
+    def get_cell_value(self, pos):
+        e = (self.board >> (4 * (4 * pos[0] + pos[1]))) & 0xF
+        return 1 << e if e else 0
@@ -0,0 +1,140 @@
+import numpy as np
+from numba import jit
+from bit_board import canonical, mask_to_cells
+from game_board import get_move_mask, get_empty_mask, line_cell
+
+# 4x4 board of uint8 log2 exponents, 0 = empty and e = a 2^e tile. Same API
+# as GameBoard but 16 bytes a board, merges are +1 and packing for keys and
+# evaluation is a shift per cell instead of a logarithm
+
+dirs = [UP, DOWN, LEFT, RIGHT] = range(4)
+
+# play dir from exponent grid a into out (may be a), returns (changed,
+# score gained). Same single pass as game_board.move_grid, merges are +1
+@jit('Tuple((boolean, float64))(uint8[:,:], uint8[:,:], int64)', nopython=True, cache=True)
+def move_exps(a, out, dir):
+    changed = False
+    score = 0.0
+    for k in range(4):
+        w = 0
+        pending = 0
+        for n in range(5):
+            if n < 4:
+                i, j = line_cell(dir, k, n)
+                e = int(a[i, j])
+                if e == 0:
+                    continue
+                if e == pending:
+                    e += 1
+                    score += 1 << e
+                    pending = 0
+                elif pending == 0:
+                    pending = e
+                    continue
+                else:
+                    e, pending = pending, e
+            elif pending != 0:
+                e = pending
+            else:
+                break
+
+            i, j = line_cell(dir, k, w)
+            if a[i, j] != e:
+                changed = True
+            out[i, j] = e
+            w += 1
+
+        for n in range(w, 4):
+            i, j = line_cell(dir, k, n)
+            if a[i, j] != 0:
+                changed = True
+            out[i, j] = 0
+    return changed, score
+
+# bit_board layout, exponent of (i, j) in bits 4 * (4 * i + j)
+@jit('uint64(uint8[:,:])', nopython=True, cache=True)
+def pack_exps(a):
+    b = np.uint64(0)
+    for i in range(4):
+        for j in range(4):
+            b |= np.uint64(a[i, j]) << np.uint64(4 * (4 * i + j))
+    return b
+
+def grid_to_exps(grid):
+    grid = np.asarray(grid, dtype=np.float64)
+    return np.log2(np.where(grid > 0, grid, 1)).astype(np.uint8)
+
+def exps_to_grid(exps):
+    return np.where(exps > 0, np.left_shift(1, exps.astype(np.int64)), 0).astype(np.float64)
+
+class ExpBoard:
+    def __init__(self, exps=None):
+        if exps is None:
+            self.exps = np.zeros((4, 4), dtype=np.uint8)
+        else:
+            self.exps = np.asarray(exps, dtype=np.uint8)
+        self.score = 0  # sum of the tiles made by merges
+
+    @classmethod
+    def from_grid(cls, grid):
+        return cls(grid_to_exps(grid))
+
+    # tile values as a 4x4 float array, same layout as GameBoard.grid
+    @property
+    def grid(self):
+        return exps_to_grid(self.exps)
+
+    def clone(self):
+        eb_copy = ExpBoard(np.copy(self.exps))
+        eb_copy.score = self.score
+        return eb_copy
+
+    def insert_tile(self, pos, value):
+        self.exps[pos[0]][pos[1]] = int(value).bit_length() - 1 if value else 0
+
+    # hashable key of the position, used by the search caches
+    def key(self):
+        return int(pack_exps(self.exps))
+
+    # (key, sym) of the minimal symmetric position, see bit_board.canonical
+    def canonical(self):
+        return canonical(self.key())
+
+    def get_available_cells(self):
+        return mask_to_cells(self.get_empty_mask())
+
+    def get_empty_mask(self):
+        return get_empty_mask(self.exps)
+
+    def count_empty(self):
+        return self.get_empty_mask().bit_count()
+
+    def get_move_mask(self):
+        return get_move_mask(self.exps)
+
+    def get_max_tile(self):
+        e = int(self.exps.max())
+        return 1 << e if e else 0
+
+    def move(self, dir, get_avail_call = False):
+        changed, score = move_exps(self.exps, self.exps, dir)
+        self.score += score
+
+        if get_avail_call:
+            return changed
+        else:
+            return None
+
+    # play dir into the board out without allocating, returns (changed, score)
+    def move_into(self, dir, out):
+        changed, score = move_exps(self.exps, out.exps, dir)
+        out.score = self.score + score
+        return changed, score
+
+    def get_available_moves(self, dirs = dirs):
+        mask = self.get_move_mask()
+        return [x for x in dirs if mask >> x & 1]
+
+    def get_cell_value(self, pos):
+        e = int(self.exps[pos[0]][pos[1]])
+        return 1 << e if e else 0
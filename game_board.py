@@ -1,143 +1,250 @@
+import math
 import numpy as np
 from numba import jit
 from helpers import print_board
+from bit_board import canonical, mask_to_cells
+from heuristics import N_TERMS, add_line, eval_terms, get_heuristic_tables
 from pprint import pprint as pp
 from timeit import default_timer as timer
 
 dirs = [UP, DOWN, LEFT, RIGHT] = range(4)
 
-# merge left where applicable
-@jit
-def merge(a):
-    for i in [0,1,2,3]:
-        for j in [0,1,2]:
-            if a[i][j] == a[i][j + 1] and a[i][j] != 0:
-                a[i][j] *= 2
-                a[i][j + 1] = 0
-    return a
-
-# slide left, out = np.zeros((4,4))
-@jit
-def justify_left(a, out):
-    for i in [0,1,2,3]:
-        c = 0
-        for j in [0,1,2,3]:
-            if a[i][j] != 0:
-                out[i][c] = a[i][j]
-                c += 1
-    return out
-
-# find which way we can move output booleans [up, down, left, right]
-@jit
-def get_available_from_zeros(a):
-    uc, dc, lc, rc = False, False, False, False
-
-    v_saw_0 = [False, False, False, False]
-    v_saw_1 = [False, False, False, False]
+# legal moves as a 4-bit mask, bit d set when direction d changes the board
+# either by sliding a tile into an empty cell or by merging a pair. Also
+# compiled for exponent grids (exp_board), where 0 is empty as well
+@jit(['int64(float64[:,:])', 'int64(uint8[:,:])'], nopython=True, cache=True)
+def get_move_mask(a):
+    mask = 0
+    for i in range(4):
+        for j in range(3):
+            # horizontal neighbours a[i][j], a[i][j+1]
+            l, r = a[i][j], a[i][j + 1]
+            if (l == 0 and r != 0) or (l != 0 and l == r):
+                mask |= 1 << LEFT
+            if (r == 0 and l != 0) or (l != 0 and l == r):
+                mask |= 1 << RIGHT
+
+            # vertical neighbours a[j][i], a[j+1][i]
+            u, d = a[j][i], a[j + 1][i]
+            if (u == 0 and d != 0) or (u != 0 and u == d):
+                mask |= 1 << UP
+            if (d == 0 and u != 0) or (u != 0 and u == d):
+                mask |= 1 << DOWN
+    return mask
+
+# empty cells as a 16-bit mask, bit 4 * i + j set when (i, j) is empty
+@jit(['int64(float64[:,:])', 'int64(uint8[:,:])'], nopython=True, cache=True)
+def get_empty_mask(a):
+    mask = 0
+    for i in range(4):
+        for j in range(4):
+            if a[i][j] == 0:
+                mask |= 1 << (4 * i + j)
+    return mask
 
+# pack grid into a 64-bit int of 4-bit log2 exponents, same layout as bit_board
+@jit('uint64(float64[:,:])', nopython=True, cache=True)
+def pack_grid(a):
+    b = np.uint64(0)
     for i in [0,1,2,3]:
-        saw_0 = False
-        saw_1 = False
-
         for j in [0,1,2,3]:
-
-            if a[i][j] == 0:
-                saw_0 = True
-                v_saw_0[j] = True
-
-                if saw_1:
-                    rc = True
-                if v_saw_1[j]:
-                    dc = True
-
-            if a[i][j] > 0:
-                saw_1 = True
-                v_saw_1[j] = True
-
-                if saw_0:
-                    lc = True
-                if v_saw_0[j]:
-                    uc = True
-
-    return [uc, dc, lc, rc]
-
+            v = a[i][j]
+            e = 0
+            while v > 1:
+                v /= 2
+                e += 1
+            b |= np.uint64(e) << np.uint64(4 * (4 * i + j))
+    return b
+
+# (row, col) of the n-th cell of line k, counted from the edge dir moves to
+@jit('UniTuple(int64, 2)(int64, int64, int64)', nopython=True, cache=True)
+def line_cell(dir, k, n):
+    if dir == LEFT:
+        return k, n
+    if dir == RIGHT:
+        return k, 3 - n
+    if dir == UP:
+        return n, k
+    return 3 - n, k
+
+# play dir from grid a into grid out, returns (changed, score gained). out
+# may be a itself. A line is read from the edge outwards and written behind
+# the read position, so in place every cell is read before it is written;
+# `pending` is the last tile read that may still merge with the next one
+@jit('Tuple((boolean, float64))(float64[:,:], float64[:,:], int64)', nopython=True, cache=True)
+def move_grid(a, out, dir):
+    changed = False
+    score = 0.0
+    for k in range(4):
+        w = 0
+        pending = 0.0
+        for n in range(5):
+            if n < 4:
+                i, j = line_cell(dir, k, n)
+                v = a[i, j]
+                if v == 0:
+                    continue
+                if v == pending:
+                    v *= 2
+                    score += v
+                    pending = 0.0
+                elif pending == 0:
+                    pending = v
+                    continue
+                else:
+                    v, pending = pending, v
+            elif pending != 0:
+                v = pending
+            else:
+                break
+
+            i, j = line_cell(dir, k, w)
+            if a[i, j] != v:
+                changed = True
+            out[i, j] = v
+            w += 1
+
+        for n in range(w, 4):
+            i, j = line_cell(dir, k, n)
+            if a[i, j] != 0:
+                changed = True
+            out[i, j] = 0
+    return changed, score
+
+# ----- running evaluation terms, see heuristics
+HEURISTIC_TABLES = np.asarray(get_heuristic_tables())
+
+# exponent line of row i (col = False) or column i, bit_board row layout
+@jit(nopython=True, cache=True)
+def grid_line(a, i, col):
+    line = 0
+    for j in range(4):
+        v = a[j, i] if col else a[i, j]
+        if v != 0:
+            line |= int(math.log2(v)) << (4 * j)
+    return line
+
+# terms of grid a from scratch, returns (empty cells, max tile)
+@jit(nopython=True, cache=True)
+def refresh_terms(a, terms, tables):
+    terms[:] = 0
+    n_empty = 0
+    max_v = 0.0
+    for i in range(4):
+        add_line(terms, grid_line(a, i, False), i, False, 1.0, tables)
+        add_line(terms, grid_line(a, i, True), i, True, 1.0, tables)
+        for j in range(4):
+            if a[i, j] == 0:
+                n_empty += 1
+            max_v = max(max_v, a[i, j])
+    return n_empty, max_v
+
+# move_grid, then the terms of out. Every line can change in a move, so
+# they are all looked up again; returns (changed, score, empty, max tile)
+@jit(nopython=True, cache=True)
+def move_terms(a, out, dir, out_terms, tables):
+    changed, score = move_grid(a, out, dir)
+    n_empty, max_v = refresh_terms(out, out_terms, tables)
+    return changed, score, n_empty, max_v
+
+# set cell (i, j) of a to v, swapping the terms of its row and column only
+@jit(nopython=True, cache=True)
+def insert_terms(a, i, j, v, terms, tables):
+    add_line(terms, grid_line(a, i, False), i, False, -1.0, tables)
+    add_line(terms, grid_line(a, j, True), j, True, -1.0, tables)
+    a[i, j] = v
+    add_line(terms, grid_line(a, i, False), i, False, 1.0, tables)
+    add_line(terms, grid_line(a, j, True), j, True, 1.0, tables)
+
+# the grid comes with running state kept up to date by move and insert_tile:
+# score (sum of merged tiles), n_empty, max_tile and the heuristic terms, so
+# evaluate, count_empty and get_max_tile are reads. Writing to grid directly
+# bypasses them
 class GameBoard:
     def __init__(self, grid=None):
         if grid is None:
             self.grid = np.zeros((4, 4))
         else:
-            self.grid = grid
+            # the kernels are compiled for float64 grids only
+            self.grid = np.asarray(grid, dtype=np.float64)
+
+        self.score = 0
+        self.terms = np.zeros(N_TERMS)
+        self.n_empty, self.max_tile = refresh_terms(self.grid, self.terms, HEURISTIC_TABLES)
 
     def clone(self):
-        gb_copy = GameBoard()
+        gb_copy = GameBoard.__new__(GameBoard)
         gb_copy.grid = np.copy(self.grid)
+        gb_copy.terms = np.copy(self.terms)
+        gb_copy.score = self.score
+        gb_copy.n_empty = self.n_empty
+        gb_copy.max_tile = self.max_tile
         return gb_copy
 
     def insert_tile(self, pos, value):
-        self.grid[pos[0]][pos[1]] = value
+        old = self.grid[pos[0]][pos[1]]
+        insert_terms(self.grid, pos[0], pos[1], value, self.terms, HEURISTIC_TABLES)
+
+        if old == 0 and value != 0:
+            self.n_empty -= 1
+        elif old != 0 and value == 0:
+            self.n_empty += 1
+        if value >= self.max_tile:
+            self.max_tile = value
+        elif old == self.max_tile:
+            self.max_tile = np.amax(self.grid)
+
+    # eval_board utility tuple from the running terms
+    def evaluate(self, n_empty, symmetric = False):
+        return eval_terms(self.terms, n_empty, self.max_tile, symmetric)
+
+    # hashable key of the position, used by the search caches
+    def key(self):
+        return int(pack_grid(self.grid))
+
+    # (key, sym) of the minimal symmetric position, see bit_board.canonical
+    def canonical(self):
+        return canonical(self.key())
 
     def get_available_cells(self):
-        cells = []
-        for x in range(4):
-            for y in range(4):
-                if self.grid[x][y] == 0:
-                    cells.append((x,y))
-        return cells
+        return mask_to_cells(self.get_empty_mask())
 
-    def get_max_tile(self):
-        return np.amax(self.grid)
+    def get_empty_mask(self):
+        return get_empty_mask(self.grid)
 
-    def slide_left(self):
-        z = np.zeros((4,4))
-        self.grid = justify_left(self.grid, z)
+    def count_empty(self):
+        return self.n_empty
 
-        self.grid = merge(self.grid)
+    def get_move_mask(self):
+        return get_move_mask(self.grid)
 
-        z = np.zeros((4,4))
-        self.grid = justify_left(self.grid, z)
+    def get_max_tile(self):
+        return self.max_tile
+
+    def slide_left(self):
+        self.move(LEFT)
 
     def move(self, dir, get_avail_call = False):
-        if get_avail_call:
-            clone = self.clone()
-
-        if dir == UP:
-            self.grid = self.grid[:,::-1].T
-            self.slide_left()
-            self.grid = self.grid.T[:,::-1]
-        if dir == DOWN:
-            self.grid = self.grid.T[:,::-1]
-            self.slide_left()
-            self.grid = self.grid[:,::-1].T
-        if dir == LEFT:
-            self.slide_left()
-        if dir == RIGHT:
-            self.grid = self.grid[:,::-1]
-            self.grid = self.grid[::-1,:]
-            self.slide_left()
-            self.grid = self.grid[:,::-1]
-            self.grid = self.grid[::-1,:]
+        changed, score, self.n_empty, self.max_tile = move_terms(
+            self.grid, self.grid, dir, self.terms, HEURISTIC_TABLES)
+        self.score += score
 
         if get_avail_call:
-            return not (clone.grid == self.grid).all()
+            return changed
         else:
             return None
 
-    def get_available_moves(self, dirs = dirs):
-        available_moves = []
-        
-        a1 = get_available_from_zeros(self.grid)
-
-        for x in dirs:
-            if not a1[x]:
-                board_clone = self.clone()
-
-                if board_clone.move(x, True):
-                    available_moves.append(x)
+    # play dir into the board out without allocating, e.g. a scratch board
+    # kept per search depth instead of a clone. Returns (changed, score)
+    def move_into(self, dir, out):
+        changed, score, out.n_empty, out.max_tile = move_terms(
+            self.grid, out.grid, dir, out.terms, HEURISTIC_TABLES)
+        out.score = self.score + score
+        return changed, score
 
-            else:
-                available_moves.append(x)
-
-        return available_moves
+    def get_available_moves(self, dirs = dirs):
+        mask = self.get_move_mask()
+        return [x for x in dirs if mask >> x & 1]
 
     def get_cell_value(self, pos):
         return self.grid[pos[0]][pos[1]]
@@ -1,9 +1,61 @@
+import os
+import hashlib
+import numpy as np
+
 # file to store utilities that are helpful across all files
 
 # gb = GameBoard
 def print_board(gb):
     for i in range(4):
         for j in range(4):
-            print("%6d  " % gb.grid[i][j], end="")
+            print("%6d  " % gb.get_cell_value((i, j)), end="")
         print("")
     print("")
+
+
+# version string of the inputs a table is built from (numbers, strings and
+# arrays), see load_table
+def table_version(*inputs):
+    h = hashlib.sha1()
+    for x in inputs:
+        if isinstance(x, np.ndarray):
+            h.update(str(x.dtype).encode())
+            h.update(np.ascontiguousarray(x).tobytes())
+        else:
+            h.update(repr(x).encode())
+    return h.hexdigest()
+
+
+# array saved at path, built with build() and saved there the first time.
+# loaded memory-mapped read-only, so processes share one copy of the pages.
+# version (see table_version) is kept in path + '.version', a saved table of
+# another version, shape or dtype is rebuilt
+def load_table(path, build, version, shape, dtype):
+    version_path = path + '.version'
+    try:
+        with open(version_path) as f:
+            saved = f.read().strip()
+        table = np.load(path, mmap_mode='r')
+        if saved == version and table.shape == shape and table.dtype == dtype:
+            return table
+    except (OSError, ValueError):
+        pass
+
+    table = build()
+    # each process writes its own temp file, so processes building the table
+    # at once never write into the same file. The version goes last, so a
+    # table cut short is never taken as current
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, table)
+        os.replace(tmp_path, path)
+        with open(version_path, 'w') as f:
+            f.write(version)
+        return np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return table
@@ -0,0 +1,319 @@
+import os
+import math
+import numpy as np
+from numba import jit
+from helpers import load_table, table_version
+
+# evaluation weights, the line lookup tables and the compiled evaluations
+# built on them, shared by ai's packed-board evaluation and the
+# incrementally evaluated GameBoard
+
+# weights we give to each prop
+MAX_W = 1
+EMPTY_W = 100
+MONO_W = 10
+SMOOTH_W = 10
+
+SNAKE_W = np.array([15,14,13,12,8,9,10,11,7,6,5,4,0,1,2,3], dtype=np.float64).reshape(4,4)
+
+# snake weights in all 8 orientations, for the symmetric evaluation mode
+def snake_symmetries(w):
+    out = np.zeros((8, 4, 4))
+    for sym in range(8):
+        t = w
+        if sym & 1:
+            t = t[:, ::-1]
+        if sym & 2:
+            t = t[::-1, :]
+        if sym & 4:
+            t = t.T
+        out[sym] = t
+    return out
+
+SNAKE_SYMMETRIES = snake_symmetries(SNAKE_W)
+
+# declared upper bounds of the utility terms, used to prune chance nodes.
+# Every line scores at most 15 in mono, smoothness is never positive
+EMPTY_MAX = math.log(16) * EMPTY_W
+MONO_MAX = 8 * 15 * MONO_W
+
+# the max tile and every snake orientation are at most the tile sum times
+# their largest weight, so any board whose tiles sum to at most tile_sum
+# has a utility of at most this
+def utility_upper_bound(tile_sum):
+    return tile_sum * (MAX_W + float(SNAKE_W.max())) + EMPTY_MAX + MONO_MAX
+
+# sum of the tiles of a packed board (see bit_board)
+def packed_tile_sum(b):
+    s = 0
+    while b:
+        e = b & 0xF
+        if e:
+            s += 1 << e
+        b >>= 4
+    return s
+
+
+# -------------------- HEURISTIC TABLES -------------------- #
+# every eval_packed term except the max tile is a sum over rows and columns
+# of something that only depends on that 16-bit line, so it can be looked up.
+# tables[k, line] for:
+T_MONO = 0      # |first - last| exponent of the line
+T_SMOOTH = 1    # smoothness of the line (next occupied neighbour pairs)
+T_MAX = 2       # max exponent in the line
+T_SNAKE = 3     # T_SNAKE + 4 * h + i: snake weight row i, columns mirrored if h
+N_TABLES = T_SNAKE + 2 * 4
+
+HEURISTIC_TABLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'heuristic_tables.npy')
+
+# the snake weights are baked into the tables, a saved file built from other
+# weights is rebuilt. Bump the first number when build_heuristic_tables changes
+HEURISTIC_TABLES_VERSION = table_version(1, N_TABLES, SNAKE_W)
+
+def build_heuristic_tables():
+    lines = np.arange(65536)
+    e = np.stack([(lines >> (4 * j)) & 0xF for j in range(4)], axis=1)
+    v = np.where(e > 0, 2.0 ** e, 0)
+
+    tables = np.zeros((N_TABLES, 65536))
+    tables[T_MONO] = np.abs(e[:, 0] - e[:, 3])
+    tables[T_MAX] = e.max(axis=1)
+
+    # pair every occupied cell with the next occupied cell after it
+    for j in range(3):
+        found = np.zeros(65536, dtype=bool)
+        for k in range(j + 1, 4):
+            pair = (e[:, j] != 0) & (e[:, k] != 0) & ~found
+            tables[T_SMOOTH] += np.where(pair, np.abs(e[:, j] - e[:, k]), 0)
+            found |= e[:, k] != 0
+
+    # the other orientations flip the row order and / or use the columns
+    for h in range(2):
+        for i in range(4):
+            tables[T_SNAKE + 4 * h + i] = v @ SNAKE_SYMMETRIES[h, i]
+
+    return tables
+
+_heuristic_tables = None
+
+# tables from HEURISTIC_TABLES_FILE, built and saved there the first time
+def get_heuristic_tables():
+    global _heuristic_tables
+
+    if _heuristic_tables is None:
+        _heuristic_tables = load_table(HEURISTIC_TABLES_FILE, build_heuristic_tables,
+                                       HEURISTIC_TABLES_VERSION, (N_TABLES, 65536), np.float64)
+
+    return _heuristic_tables
+
+
+# -------------------- RUNNING TERMS -------------------- #
+# the table sums of a board kept in a float64 array, updated per changed
+# line instead of recomputed (see GameBoard). All terms are whole numbers,
+# so adding and removing lines never drifts from a fresh sum
+R_MONO = 0
+R_SMOOTH = 1
+R_SNAKE = 2     # R_SNAKE + sym: snake term in orientation sym
+N_TERMS = R_SNAKE + 8
+
+# add sign * the terms of line, row i (col = False) or column i
+@jit(nopython=True, cache=True)
+def add_line(terms, line, i, col, sign, tables):
+    terms[R_MONO] += sign * tables[T_MONO, line]
+    terms[R_SMOOTH] += sign * tables[T_SMOOTH, line]
+
+    # orientations 4..7 score the columns, as in eval_packed_tables
+    base = R_SNAKE + 4 if col else R_SNAKE
+    for sym in range(4):
+        w = 3 - i if sym & 2 else i
+        terms[base + sym] += sign * tables[T_SNAKE + 4 * (sym & 1) + w, line]
+
+# eval_packed's utility tuple from running terms and the max tile max_v
+@jit(nopython=True, cache=True)
+def eval_terms(terms, n_empty, max_v, symmetric):
+    snake_u = terms[R_SNAKE]
+    if symmetric:
+        for sym in range(1, 8):
+            snake_u = max(snake_u, terms[R_SNAKE + sym])
+
+    max_u = max_v * MAX_W
+    empty_u = (math.log(n_empty) * EMPTY_W) if n_empty != 0 else 0.0
+    mono_u = terms[R_MONO] * MONO_W
+    smooth_u = -(terms[R_SMOOTH] * SMOOTH_W)
+
+    # ----- total
+    utility = empty_u + mono_u + smooth_u
+    utility += max_u
+    utility += snake_u
+
+    return (utility, empty_u, mono_u, smooth_u)
+
+
+# -------------------- EVALUATION -------------------- #
+# every compiled kernel that reads the weights lives in this file. Numba
+# freezes globals into a kernel when compiling it and only drops the cached
+# kernel when its own source file changes, so a kernel elsewhere reading or
+# calling into the weights would keep the old ones until __pycache__ is
+# cleared
+
+# log2 exponent of cell (i, j) of a packed board (0 = empty)
+@jit('uint64(uint64, int64, int64)', nopython=True, cache=True)
+def cell_exp(b, i, j):
+    return (b >> np.uint64(4 * (4 * i + j))) & np.uint64(0xF)
+
+# evaluate a packed board (see bit_board) in one pass, without allocating
+@jit('UniTuple(float64, 4)(uint64, int64, boolean)', nopython=True, cache=True)
+def eval_packed(b, n_empty, symmetric):
+    # evaluate board on 4 properties:
+    # 1. max value in board
+    # 2. number of empty tiles
+    # 3. monotonicity
+    # 4. smoothness
+    # 5. snake
+    max_v = 0.0
+    snake_u = 0.0
+    smooth = 0.0
+    mono_h = 0.0
+    mono_v = 0.0
+
+    for i in range(4):
+        # differences in horizontally / vertically adjacent, summed along
+        # the line, which leaves first minus last
+        mono_h += abs(float(cell_exp(b, i, 0)) - float(cell_exp(b, i, 3)))
+        mono_v += abs(float(cell_exp(b, 0, i)) - float(cell_exp(b, 3, i)))
+
+        for j in range(4):
+            e = cell_exp(b, i, j)
+            if e == 0:
+                continue
+
+            v = float(np.uint64(1) << e)
+            if v > max_v:
+                max_v = v
+            if not symmetric:
+                snake_u += v * SNAKE_W[i, j]
+
+            # smoothness against next occupied cell to the right
+            k = 1
+            while j + k < 3 and cell_exp(b, i, j + k) == 0:
+                k += 1
+            if j + k <= 3 and cell_exp(b, i, j + k) != 0:
+                smooth += abs(float(e) - float(cell_exp(b, i, j + k)))
+
+            # and below
+            k = 1
+            while i + k < 3 and cell_exp(b, i + k, j) == 0:
+                k += 1
+            if i + k <= 3 and cell_exp(b, i + k, j) != 0:
+                smooth += abs(float(e) - float(cell_exp(b, i + k, j)))
+
+    if symmetric:
+        # best fitting orientation, invariant under rotations / reflections
+        snake_u = -np.inf
+        for sym in range(8):
+            s = 0.0
+            for i in range(4):
+                for j in range(4):
+                    e = cell_exp(b, i, j)
+                    if e != 0:
+                        s += float(np.uint64(1) << e) * SNAKE_SYMMETRIES[sym, i, j]
+            if s > snake_u:
+                snake_u = s
+
+    max_u = max_v * MAX_W
+    empty_u = (math.log(n_empty) * EMPTY_W) if n_empty != 0 else 0.0
+    mono_u = (mono_h + mono_v) * MONO_W
+    smooth_u = -(smooth * SMOOTH_W)
+
+    # ----- total
+    utility = empty_u + mono_u + smooth_u
+    utility += max_u
+    utility += snake_u
+
+    return (utility, empty_u, mono_u, smooth_u)
+
+
+# number of empty cells of a packed board
+@jit('int64(uint64)', nopython=True, cache=True)
+def count_empty(b):
+    n = 0
+    for i in range(16):
+        if (b >> np.uint64(4 * i)) & np.uint64(0xF) == 0:
+            n += 1
+    return n
+
+# evaluate N packed boards, returns (N, 4) utility tuples
+@jit('float64[:,:](uint64[:], boolean)', nopython=True, cache=True)
+def eval_packed_batch(boards, symmetric):
+    out = np.empty((boards.shape[0], 4))
+    for n in range(boards.shape[0]):
+        u = eval_packed(boards[n], count_empty(boards[n]), symmetric)
+        out[n, 0] = u[0]
+        out[n, 1] = u[1]
+        out[n, 2] = u[2]
+        out[n, 3] = u[3]
+    return out
+
+# bit_board.transpose, compiled
+@jit('uint64(uint64)', nopython=True, cache=True)
+def transpose_packed(b):
+    a1 = b & np.uint64(0xF0F00F0FF0F00F0F)
+    a2 = b & np.uint64(0x0000F0F00000F0F0)
+    a3 = b & np.uint64(0x0F0F00000F0F0000)
+    a = a1 | (a2 << np.uint64(12)) | (a3 >> np.uint64(12))
+    b1 = a & np.uint64(0xFF00FF0000FF00FF)
+    b2 = a & np.uint64(0x00FF00FF00000000)
+    b3 = a & np.uint64(0x00000000FF00FF00)
+    return b1 | (b2 >> np.uint64(24)) | (b3 << np.uint64(24))
+
+# eval_packed from 4 row and 4 column lookups per table, same result
+@jit(nopython=True, cache=True)
+def eval_packed_tables(b, n_empty, symmetric, tables):
+    t = transpose_packed(b)
+
+    mono = 0.0
+    smooth = 0.0
+    max_e = 0.0
+    for i in range(4):
+        row = (b >> np.uint64(16 * i)) & np.uint64(0xFFFF)
+        col = (t >> np.uint64(16 * i)) & np.uint64(0xFFFF)
+        mono += tables[T_MONO, row] + tables[T_MONO, col]
+        smooth += tables[T_SMOOTH, row] + tables[T_SMOOTH, col]
+        max_e = max(max_e, tables[T_MAX, row])
+
+    # the position dependent part, orientation sym as in SNAKE_SYMMETRIES:
+    # bit 0 mirrors the weight columns, bit 1 reverses the weight rows and
+    # bit 2 transposes them, i.e. scores the columns instead of the rows
+    snake_u = -np.inf
+    for sym in range(8 if symmetric else 1):
+        lines = t if sym & 4 else b
+        s = 0.0
+        for i in range(4):
+            line = (lines >> np.uint64(16 * i)) & np.uint64(0xFFFF)
+            w = 3 - i if sym & 2 else i
+            s += tables[T_SNAKE + 4 * (sym & 1) + w, line]
+        if s > snake_u:
+            snake_u = s
+
+    max_u = (2.0 ** max_e if max_e > 0 else 0.0) * MAX_W
+    empty_u = (math.log(n_empty) * EMPTY_W) if n_empty != 0 else 0.0
+    mono_u = mono * MONO_W
+    smooth_u = -(smooth * SMOOTH_W)
+
+    # ----- total
+    utility = empty_u + mono_u + smooth_u
+    utility += max_u
+    utility += snake_u
+
+    return (utility, empty_u, mono_u, smooth_u)
+
+@jit(nopython=True, cache=True)
+def eval_packed_tables_batch(boards, symmetric, tables):
+    out = np.empty((boards.shape[0], 4))
+    for n in range(boards.shape[0]):
+        u = eval_packed_tables(boards[n], count_empty(boards[n]), symmetric, tables)
+        out[n, 0] = u[0]
+        out[n, 1] = u[1]
+        out[n, 2] = u[2]
+        out[n, 3] = u[3]
+    return out
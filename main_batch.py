@@ -1,92 +1,126 @@
-import numpy as np
-from game_board import GameBoard, merge, justify_left, get_available_from_zeros
-from ai import Expectimax, MonteCarlo, get_smoothness
 from game_board import GameBoard
-from random import randint
+from exp_board import ExpBoard
+from bit_board import BitBoard
+from ai import Expectimax, MonteCarlo
+from telemetry import JsonlSink, SlowestProfiler
+import os
+import json
+import numpy as np
+from random import Random
 from timeit import default_timer as timer
-from time import sleep
 from collections import Counter
-from joblib import Parallel, delayed
+from multiprocessing import Pool
 from sys import argv
 
 
 DELAY = 0
 
-# first calls for Numba to compile fast versions
-temp = np.zeros((4, 4))
-merge(temp)
-justify_left(temp, temp)
-get_available_from_zeros(temp)
-get_smoothness(temp)
-sleep(1)
+# board classes play_game can use, options['board']
+BOARDS = {'GameBoard': GameBoard, 'ExpBoard': ExpBoard, 'BitBoard': BitBoard}
+
+# kernels are compiled once and cached on disk by Numba (see cache=True), so
+# this only loads them; a tiny search touches everything a game will use
+def warm_up():
+    temp_board = GameBoard()
+    temp_board.insert_tile((0, 0), 2)
+    Expectimax().get_move(temp_board)
 
 class Batch:
-    def __init__(self):
+    # telemetry is a telemetry.TelemetrySink for the ai's per-move stats,
+    # profile_slowest > 0 keeps cProfile output of that many slowest moves,
+    # board is the board class to play on, ai_options go to Expectimax.
+    # play = False only sets the game up, the caller plays it move by move
+    # with play_move and calls finish (see play_lockstep)
+    def __init__(self, seed = None, telemetry = None, profile_slowest = 0, board = GameBoard, ai_options = {},
+                 play = True):
+        self.rng = Random(seed)
+        self.profiler = SlowestProfiler(profile_slowest) if profile_slowest else None
+
         # MEASURES
         self.total_moves_time = 0
         self.total_moves = 0
         self.fastest_move = -1
         self.longest_move = 0
         self.time_to_reach = []
+        self.cur_max_tile = 8 # next tile for time_to_reach
 
         # setup game & ai
-        self.board = GameBoard()
-        self.ai = Expectimax()
+        self.board = board()
+        self.ai = Expectimax(telemetry=telemetry, **ai_options)
         self.init_game()
 
         # run ai on game
         self.start = timer()
-        self.run_game()
-        end = timer()
+        if play:
+            self.run_game()
+            self.finish(timer() - self.start)
 
+    def finish(self, total_time):
         # MEASURES
-        self.total_time = end - self.start # total time to run
+        self.total_time = total_time # total time to run
         self.avg_move_time = self.total_moves_time / self.total_moves # moves done
         self.max_tile = self.board.get_max_tile() # max tile
+        self.score = self.board.score # game score, sum of merged tiles
         self.states_visited = self.ai.states_visited # states visited
+        self.fallbacks = self.ai.total_fallbacks # nodes left static by the node budget
+
+        # transposition table, only Expectimax has one
+        cache = getattr(self.ai, 'cache', None)
+        self.cache_hits = cache.hits if cache is not None else 0
+        self.cache_misses = cache.misses if cache is not None else 0
+        self.cache_evictions = cache.evictions if cache is not None else 0
 
     def init_game(self):
         self.insert_random_tile()
         self.insert_random_tile()
 
     def run_game(self):
-        cur_max_tile = 8
         while True:
             move_start = timer()
-            move = self.ai.get_move(self.board)
+            if self.profiler is None:
+                move = self.ai.get_move(self.board)
+            else:
+                move = self.profiler.run(self.total_moves, self.ai.get_move, self.board)
             move_end = timer()
-            
-            # save move time
-            move_time = move_end - move_start
-            self.total_moves_time += move_time
-            self.total_moves += 1
-            if self.fastest_move == -1 or move_time < self.fastest_move:
-                self.fastest_move = move_time
-            if move_time > self.longest_move:
-                self.longest_move = move_time
-
-            # do the actual move + the response
-            self.board.move(move)
-            self.insert_random_tile()
-
-            # check if we got a bigger tile
-            if cur_max_tile in self.board.grid:
-                reached_end = timer()
-                self.time_to_reach.append((cur_max_tile, reached_end - self.start))
-                cur_max_tile *= 2
-
-            # if no more moves, game over
-            if len(self.board.get_available_moves()) == 0:
+
+            if self.play_move(move, move_end - move_start):
                 break
 
+    # play the ai's move and the tile response, move_time is how long the
+    # move took and elapsed the game's time so far (wall time since the start
+    # by default). True once the game is over
+    def play_move(self, move, move_time, elapsed = None):
+        # save move time
+        self.total_moves_time += move_time
+        self.total_moves += 1
+        if self.fastest_move == -1 or move_time < self.fastest_move:
+            self.fastest_move = move_time
+        if move_time > self.longest_move:
+            self.longest_move = move_time
+
+        # do the actual move + the response
+        self.board.move(move)
+        self.insert_random_tile()
+
+        # check if we got a bigger tile, max tile grows at most one
+        # doubling per move
+        if self.board.get_max_tile() >= self.cur_max_tile:
+            if elapsed is None:
+                elapsed = timer() - self.start
+            self.time_to_reach.append((self.cur_max_tile, elapsed))
+            self.cur_max_tile *= 2
+
+        # if no more moves, game over
+        return len(self.board.get_available_moves()) == 0
+
     def insert_random_tile(self):
-        if randint(0,99) < 100 * 0.9:
+        if self.rng.randint(0,99) < 100 * 0.9:
             value = 2
         else:
             value = 4
 
         cells = self.board.get_available_cells()
-        pos = cells[randint(0, len(cells) - 1)] if cells else None
+        pos = cells[self.rng.randint(0, len(cells) - 1)] if cells else None
 
         if pos is None:
             return None
@@ -94,86 +128,362 @@ class Batch:
             self.board.insert_tile(pos, value)
             return pos
 
-def log_test(b):
-    outputnum = argv[1]
-    with open('output' + outputnum + '.log', 'a') as f:
+    # compact per-game result, one line of the results file
+    def to_record(self, game, seed):
+        return {
+            'game': game,
+            'seed': seed,
+            'max_tile': int(self.max_tile),
+            'score': int(self.score),
+            'total_moves': self.total_moves,
+            'states_visited': self.states_visited,
+            'fallbacks': self.fallbacks,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'cache_evictions': self.cache_evictions,
+            'total_time': self.total_time,
+            'avg_move_time': self.avg_move_time,
+            'fastest_move': self.fastest_move,
+            'longest_move': self.longest_move,
+            'time_to_reach': [[int(tile), time] for tile, time in self.time_to_reach]
+        }
+
+# game = (game number, seed, run id, options), returns the game's record.
+# options: 'telemetry' writes per-move stats to telemetry<id>_<game>.jsonl,
+# 'profile_slowest' dumps that many move profiles to profile<id>_<game>.txt,
+# 'board' names one of BOARDS to play on (GameBoard by default),
+# 'node_budget' / 'memory_limit' cap the search of every move (see Expectimax)
+def play_game(game):
+    number, seed, run_id, options = game
+    name = run_id + '_' + str(number)
+
+    telemetry = JsonlSink('telemetry' + name + '.jsonl') if options.get('telemetry') else None
+    board = BOARDS[options.get('board', 'GameBoard')]
+    ai_options = {k: options[k] for k in ('batch_leaves', 'node_budget', 'memory_limit') if k in options}
+    b = Batch(seed, telemetry, options.get('profile_slowest', 0), board, ai_options)
+
+    if b.profiler is not None:
+        b.profiler.dump('profile' + name + '.txt')
+
+    return b.to_record(number, seed)
+
+# the play_game options play_lockstep supports
+LOCKSTEP_OPTIONS = ('board', 'batch_leaves', 'node_budget', 'memory_limit', 'lockstep')
+
+# play_game for a list of games played side by side, returns their records.
+# Every round each unfinished game runs its search (Expectimax.search_steps)
+# up to the leaves it needs next, then the leaves of all of them are scored
+# by one batched evaluation. Only batch_leaves searches hand their leaves
+# out, so it is always on here: each game plays exactly as play_game would
+# with its seed and options['batch_leaves'] = True. A game's times are its
+# own search work plus its share (by leaves) of the batched evaluations. All
+# games must have the same options; telemetry, profiling and anything else
+# play_lockstep cannot honour raise ValueError
+def play_lockstep(games):
+    options = games[0][3]
+    if any(game[3] != options for game in games):
+        raise ValueError('lockstep games must share their options')
+    unsupported = sorted(k for k in options if options[k] and k not in LOCKSTEP_OPTIONS)
+    if unsupported:
+        raise ValueError('options %s are not supported in lockstep' % ', '.join(unsupported))
+
+    board = BOARDS[options.get('board', 'GameBoard')]
+    ai_options = {k: options[k] for k in ('node_budget', 'memory_limit') if k in options}
+    ai_options['batch_leaves'] = True
+
+    batches = [Batch(seed, board=board, ai_options=ai_options, play=False) for _, seed, _, _ in games]
+    evaluate_batch = batches[0].ai.evaluate_batch  # the same for every game
+    searches = [None] * len(batches)  # search generator of the current move
+    move_times = [0.0] * len(batches)
+    clocks = [0.0] * len(batches)     # time of the game so far
+
+    # run game g until its search waits for leaves, which are returned,
+    # sending it scores first. None once the game is over
+    def advance(g, scores):
+        b = batches[g]
+        while True:
+            t0 = timer()
+            if searches[g] is None:
+                searches[g] = b.ai.search_steps(b.board)
+                scores = None
+            try:
+                leaves = searches[g].send(scores)
+                move_times[g] += timer() - t0
+                return leaves
+            except StopIteration as done:
+                move = done.value
+            move_times[g] += timer() - t0
+            clocks[g] += move_times[g]
+            searches[g] = None
+
+            game_over = b.play_move(move, move_times[g], clocks[g])
+            move_times[g] = 0.0
+            if game_over:
+                b.finish(clocks[g])
+                return None
+
+    pending = {}
+    for g in range(len(batches)):
+        leaves = advance(g, None)
+        if leaves is not None:
+            pending[g] = leaves
+
+    while pending:
+        t0 = timer()
+        scores = evaluate_batch(np.concatenate(list(pending.values())))
+        share = (timer() - t0) / len(scores)
+
+        waiting = {}
+        i = 0
+        for g, leaves in pending.items():
+            n = len(leaves)
+            move_times[g] += share * n
+            leaves = advance(g, scores[i:i + n])
+            i += n
+            if leaves is not None:
+                waiting[g] = leaves
+        pending = waiting
+
+    return [b.to_record(number, seed) for b, (number, seed, _, _) in zip(batches, games)]
+
+# running sums over game records, averages can be written at any point
+class BatchStats:
+    def __init__(self):
+        self.tests = 0
+        self.max_tile_list = []
+        self.score_sum = 0
+        self.total_moves_sum = 0
+        self.states_visited_sum = 0
+        self.fallbacks_sum = 0
+        self.cache_hits_sum = 0
+        self.cache_misses_sum = 0
+        self.total_time_sum = 0
+        self.avg_move_time_sum = 0
+        self.fastest_move_sum = 0
+        self.longest_move_sum = 0
+        self.time_to_reach_sum = {}
+
+    def add(self, r):
+        self.tests += 1
+        self.max_tile_list.append(r['max_tile'])
+        self.score_sum += r['score']
+        self.total_moves_sum += r['total_moves']
+        self.states_visited_sum += r['states_visited']
+        self.fallbacks_sum += r['fallbacks']
+        self.cache_hits_sum += r['cache_hits']
+        self.cache_misses_sum += r['cache_misses']
+        self.total_time_sum += r['total_time']
+        self.avg_move_time_sum += r['avg_move_time']
+        self.fastest_move_sum += r['fastest_move']
+        self.longest_move_sum += r['longest_move']
+        for tile, time in r['time_to_reach']:
+            if tile not in self.time_to_reach_sum:
+                self.time_to_reach_sum[tile] = (0,0)
+            num = self.time_to_reach_sum[tile][0] + 1
+            new_time = self.time_to_reach_sum[tile][1] + time
+            self.time_to_reach_sum[tile] = (num, new_time)
+
+    def write_average(self, path):
+        tests = self.tests
+        if tests == 0:
+            return
+
+        avg_max_tile = Counter(self.max_tile_list).most_common(1)[0][0]
+
+        with open(path, 'w') as f:
+            f.write('Games: %d\n' % tests)
+            f.write('Average Max Tile: %d\n' % avg_max_tile)
+            f.write('Average Score: %f\n' % (self.score_sum / tests))
+            f.write('Average Total Moves: %f\n' % (self.total_moves_sum / tests))
+            f.write('Average Total States Visited: %f\n' % (self.states_visited_sum / tests))
+            f.write('Average Static Fallbacks: %f\n' % (self.fallbacks_sum / tests))
+            f.write('Average Cache Hits: %f\n' % (self.cache_hits_sum / tests))
+            f.write('Average Cache Misses: %f\n' % (self.cache_misses_sum / tests))
+            f.write('Average Total Time: %f\n' % (self.total_time_sum / tests))
+            f.write('Average Time / Move: %f\n' % (self.avg_move_time_sum / tests))
+            f.write('Average Fastest Move: %f\n' % (self.fastest_move_sum / tests))
+            f.write('Average Longest Move: %f\n' % (self.longest_move_sum / tests))
+            f.write('Average Time To Get Tiles:\n')
+            for tile, value in sorted(self.time_to_reach_sum.items()):
+                num, time = value
+                f.write('%d: %f\n' % (tile, time / num))
+
+def log_test(path, r):
+    with open(path, 'a') as f:
         f.write('-----\n')
-        f.write('Max Tile: %d\n' % b.max_tile)
-        f.write('Total Moves: %d\n' % b.total_moves)
-        f.write('Total States Visited: %d\n' % b.states_visited)
-        f.write('Total Time: %f\n' % b.total_time)
-        f.write('Average Time / Move: %f\n' % b.avg_move_time)
-        f.write('Fastest Move: %f\n' % b.fastest_move)
-        f.write('Longest Move: %f\n' % b.longest_move)
+        f.write('Game: %d (seed %d)\n' % (r['game'], r['seed']))
+        f.write('Max Tile: %d\n' % r['max_tile'])
+        f.write('Score: %d\n' % r['score'])
+        f.write('Total Moves: %d\n' % r['total_moves'])
+        f.write('Total States Visited: %d\n' % r['states_visited'])
+        f.write('Static Fallbacks: %d\n' % r['fallbacks'])
+        f.write('Cache Hits: %d\n' % r['cache_hits'])
+        f.write('Cache Misses: %d\n' % r['cache_misses'])
+        f.write('Cache Evictions: %d\n' % r['cache_evictions'])
+        f.write('Total Time: %f\n' % r['total_time'])
+        f.write('Average Time / Move: %f\n' % r['avg_move_time'])
+        f.write('Fastest Move: %f\n' % r['fastest_move'])
+        f.write('Longest Move: %f\n' % r['longest_move'])
         f.write('Time To Get Tiles:\n')
-        for tile, time in b.time_to_reach:
+        for tile, time in r['time_to_reach']:
             f.write('%d: %f\n' % (tile, time))
 
-def parallel_runs():
-    return (Batch(),)
+# records of a results file; a line cut short by a crash is skipped
+def read_records(path):
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return records
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+# write to a temp file and rename, so a crash never leaves half a checkpoint
+def write_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+# play_game options that change how a game is played (telemetry, profiling
+# and how many games share a lockstep do not). Lockstep plays the
+# batch_leaves search
+ENGINE_OPTIONS = ('board', 'batch_leaves', 'node_budget', 'memory_limit')
+
+def engine_options(options):
+    engine = {k: options[k] for k in ENGINE_OPTIONS if options.get(k)}
+    engine.setdefault('board', 'GameBoard')
+    if options.get('lockstep', 0) > 1:
+        engine['batch_leaves'] = True
+    return engine
+
+# play games 0..games-1 with seeds base_seed + game on `workers` processes.
+# every finished game is appended to results<id>.jsonl and output<id>.log as
+# soon as it arrives and averages are kept up to date in average<id>.log.
+#
+# checkpoint<id>.json holds the run settings (including the seed, picked at
+# random if none was given), written once when the run starts. The results
+# file is the record of finished games: starting the same run id again skips
+# them and rebuilds the averages from it; without a checkpoint the run
+# starts fresh and clears its old output files.
+#
+# options are passed to play_game (telemetry / profiling), options['lockstep']
+# = K plays the games K at a time with play_lockstep. They are stored in the
+# checkpoint too: a resumed run given games / options None takes the stored
+# ones, and options that play differently (engine_options) raise ValueError
+def run_batch(run_id, games = None, workers = 1, base_seed = None, options = None):
+    results_path = 'results' + run_id + '.jsonl'
+    output_path = 'output' + run_id + '.log'
+    average_path = 'average' + run_id + '.log'
+    checkpoint_path = 'checkpoint' + run_id + '.json'
+
+    checkpoint = read_checkpoint(checkpoint_path)
+
+    if checkpoint is None:
+        if base_seed is None:
+            base_seed = Random().randrange(2 ** 32)
+        if games is None:
+            games = 10
+        if options is None:
+            options = {}
+        checkpoint = {'run_id': run_id, 'games': games, 'base_seed': base_seed, 'options': options}
 
-def run_parallel():
-    jobs = 10
-    tests = 10 / jobs
-    return Parallel(n_jobs=jobs, verbose=0)(delayed(parallel_runs)() for i in range(int(tests)))
+        open(results_path, 'w').close()
+        open(output_path, 'w').close()
+        open(average_path, 'w').close()
+    else:
+        if base_seed is not None and base_seed != checkpoint['base_seed']:
+            raise ValueError('run %s was started with seed %d, not %d' % (run_id, checkpoint['base_seed'], base_seed))
+        base_seed = checkpoint['base_seed']
 
-def main_parallel():
-    open('output.log', 'w').close()
-    open('average.log', 'w').close()
+        if options is None:
+            options = checkpoint['options']
+        elif engine_options(options) != engine_options(checkpoint['options']):
+            raise ValueError('run %s was started with options %s, not %s'
+                             % (run_id, engine_options(checkpoint['options']), engine_options(options)))
+        checkpoint['options'] = options
 
-    b_total = run_parallel()
-    print(b_total)
+        if games is None:
+            games = checkpoint['games']
+        checkpoint['games'] = games
 
+    records = {}
+    for r in read_records(results_path):
+        records.setdefault(r['game'], r)
+
+    # a line cut short by a crash is ended, so the next record starts a line
+    # of its own
+    with open(results_path, 'ab+') as results:
+        size = results.seek(0, os.SEEK_END)
+        if size > 0:
+            results.seek(size - 1)
+            if results.read(1) != b'\n':
+                results.write(b'\n')
+
+    write_checkpoint(checkpoint_path, checkpoint)
+
+    stats = BatchStats()
+    for game in sorted(records):
+        stats.add(records[game])
+    stats.write_average(average_path)
+
+    pending = [(game, base_seed + game, run_id, options) for game in range(games) if game not in records]
+
+    # before forking, so workers start warm
+    warm_up()
+
+    lockstep = options.get('lockstep', 0)
+    if lockstep > 1:
+        play = play_lockstep
+        pending = [pending[i:i + lockstep] for i in range(0, len(pending), lockstep)]
+    else:
+        play = play_game
+
+    if workers > 1:
+        pool = Pool(workers)
+        finished = pool.imap_unordered(play, pending)
+    else:
+        pool = None
+        finished = map(play, pending)
+
+    if play is play_lockstep:
+        finished = (r for group in finished for r in group)
+
+    try:
+        with open(results_path, 'a') as results:
+            for r in finished:
+                results.write(json.dumps(r) + '\n')
+                results.flush()
+
+                log_test(output_path, r)
+                stats.add(r)
+                stats.write_average(average_path)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return stats
+
+# python3 main_batch.py <run id> [games] [workers] [base seed] [lockstep]
+# games and the options default to the stored ones when resuming a run
 def main():
-    outputnum = argv[1]
-    open('output' + outputnum + '.log', 'w').close()
-    open('average' + outputnum + '.log', 'w').close()
-    tests = 0
-
-    max_tile_list = []
-    total_moves_sum = 0
-    states_visited_sum = 0
-    total_time_sum = 0
-    avg_move_time_sum = 0
-    fastest_move_sum = 0
-    longest_move_sum = 0
-    time_to_reach_sum = {}
-
-    while tests < 10:
-        b = Batch()
-        
-        max_tile_list.append(b.max_tile)
-        total_moves_sum += b.total_moves
-        states_visited_sum += b.states_visited
-        total_time_sum += b.total_time
-        avg_move_time_sum += b.avg_move_time
-        fastest_move_sum += b.fastest_move
-        longest_move_sum += b.longest_move
-        for tile, time in b.time_to_reach:
-            if tile not in time_to_reach_sum:
-                time_to_reach_sum[tile] = (0,0)
-            num = time_to_reach_sum[tile][0] + 1
-            new_time = time_to_reach_sum[tile][1] + time
-            time_to_reach_sum[tile] = (num, new_time)
-
-        log_test(b)
-
-        tests += 1
-
-    avg_max_tile = Counter(max_tile_list).most_common(1)[0][0]
-
-    with open('average' + outputnum + '.log', 'w') as f:
-        f.write('Average Max Tile: %d\n' % avg_max_tile)
-        f.write('Average Total Moves: %f\n' % (total_moves_sum / tests))
-        f.write('Average Total States Visited: %f\n' % (states_visited_sum / tests))
-        f.write('Average Total Time: %f\n' % (total_time_sum / tests))
-        f.write('Average Time / Move: %f\n' % (avg_move_time_sum / tests))
-        f.write('Average Fastest Move: %f\n' % (fastest_move_sum / tests))
-        f.write('Average Longest Move: %f\n' % (longest_move_sum / tests))
-        f.write('Average Time To Get Tiles:\n')
-        for tile, value in time_to_reach_sum.items():
-            num, time = value
-            f.write('%d: %f\n' % (tile, time / num))
+    run_id = argv[1]
+    games = int(argv[2]) if len(argv) > 2 else None
+    workers = int(argv[3]) if len(argv) > 3 else 1
+    base_seed = int(argv[4]) if len(argv) > 4 else None
+    options = {'lockstep': int(argv[5])} if len(argv) > 5 else None
+
+    run_batch(run_id, games, workers, base_seed, options=options)
 
 
 if __name__ == '__main__':
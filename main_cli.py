@@ -43,6 +43,7 @@ class CLIRunner:
 
             if len(self.board.get_available_moves()) == 0:
                 print("GAME OVER (max tile): " + str(self.board.get_max_tile()))
+                print("Score: " + str(int(self.board.score)))
                 break
 
             moves += 1
@@ -63,7 +63,7 @@ class GameGrid(Frame):
 
         self.grid_cells[1][1].configure(text="TOP",bg=BACKGROUND_COLOR_CELL_EMPTY)
         self.grid_cells[1][2].configure(text="4 TILES:",bg=BACKGROUND_COLOR_CELL_EMPTY)
-        top_4 = list(map(int, reversed(sorted(list(self.board.grid.flatten())))))
+        top_4 = sorted((int(self.board.get_cell_value((i, j))) for i in range(GRID_LEN) for j in range(GRID_LEN)), reverse=True)
         self.grid_cells[2][0].configure(text=str(top_4[0]), bg=BACKGROUND_COLOR_DICT[2048], fg=CELL_COLOR_DICT[2048])
         self.grid_cells[2][1].configure(text=str(top_4[1]), bg=BACKGROUND_COLOR_DICT[2048], fg=CELL_COLOR_DICT[2048])
         self.grid_cells[2][2].configure(text=str(top_4[2]), bg=BACKGROUND_COLOR_DICT[2048], fg=CELL_COLOR_DICT[2048])
@@ -99,7 +99,7 @@ class GameGrid(Frame):
     def update_grid_cells(self):
         for i in range(GRID_LEN):
             for j in range(GRID_LEN):
-                new_number = int(self.board.grid[i][j])
+                new_number = int(self.board.get_cell_value((i, j)))
                 if new_number == 0:
                     self.grid_cells[i][j].configure(text="", bg=BACKGROUND_COLOR_CELL_EMPTY)
                 else:
@@ -0,0 +1,81 @@
+import numpy as np
+from bit_board import ROW_LEFT, ROW_RIGHT, UP, DOWN, LEFT, RIGHT
+
+# random playouts of many packed boards (see bit_board) advanced in lockstep,
+# every ply is a handful of array operations over the whole batch
+
+ROW_SHIFTS = np.array([0, 16, 32, 48], dtype=np.uint64)
+CELL_SHIFTS = np.arange(0, 64, 4, dtype=np.uint64)
+
+# bit_board.transpose, on uint64 arrays
+def transpose_batch(b):
+    a1 = b & np.uint64(0xF0F00F0FF0F00F0F)
+    a2 = b & np.uint64(0x0000F0F00000F0F0)
+    a3 = b & np.uint64(0x0F0F00000F0F0000)
+    a = a1 | (a2 << np.uint64(12)) | (a3 >> np.uint64(12))
+    b1 = a & np.uint64(0xFF00FF0000FF00FF)
+    b2 = a & np.uint64(0x00FF00FF00000000)
+    b3 = a & np.uint64(0x00000000FF00FF00)
+    return b1 | (b2 >> np.uint64(24)) | (b3 << np.uint64(24))
+
+def apply_row_table_batch(b, table):
+    rows = (b[:, None] >> ROW_SHIFTS) & np.uint64(0xFFFF)
+    moved = table[rows].astype(np.uint64) << ROW_SHIFTS
+    return np.bitwise_or.reduce(moved, axis=1)
+
+def move_batch(b, dir):
+    if dir == LEFT:
+        return apply_row_table_batch(b, ROW_LEFT)
+    if dir == RIGHT:
+        return apply_row_table_batch(b, ROW_RIGHT)
+    if dir == UP:
+        return transpose_batch(apply_row_table_batch(transpose_batch(b), ROW_LEFT))
+    if dir == DOWN:
+        return transpose_batch(apply_row_table_batch(transpose_batch(b), ROW_RIGHT))
+    return b
+
+# (N, 4) boards after each move, and which of them are legal
+def all_moves_batch(b):
+    moved = np.stack([move_batch(b, dir) for dir in [UP, DOWN, LEFT, RIGHT]], axis=1)
+    return moved, moved != b[:, None]
+
+# (N, 16) True where the cell is empty
+def empty_mask_batch(b):
+    return ((b[:, None] >> CELL_SHIFTS) & np.uint64(0xF)) == 0
+
+# pick a uniformly random True column per row, -1 where there is none
+def random_choice_batch(mask, rng):
+    keys = np.where(mask, rng.random(mask.shape), -1.0)
+    picks = np.argmax(keys, axis=1)
+    picks[~mask.any(axis=1)] = -1
+    return picks
+
+# spawn a 2 (90%) or 4 (10%) on a random empty cell of every board in rows
+def spawn_batch(b, rows, rng):
+    cells = random_choice_batch(empty_mask_batch(b[rows]), rng)
+    rows = rows[cells >= 0]
+    cells = cells[cells >= 0]
+    exps = np.where(rng.random(len(rows)) < 0.9, 1, 2).astype(np.uint64)
+    b[rows] |= exps << (cells.astype(np.uint64) * np.uint64(4))
+
+# play first_moves[i] on boards[i], then alternate random tile spawns and
+# random legal moves for depth plies; games that end early stay frozen.
+# returns the final boards
+def rollout_batch(boards, first_moves, depth, rng):
+    b = np.asarray(boards, dtype=np.uint64).copy()
+    idx = np.arange(len(b))
+
+    moved, _ = all_moves_batch(b)
+    b = moved[idx, first_moves]
+
+    for _ in range(depth):
+        spawn_batch(b, idx, rng)
+
+        moved, legal = all_moves_batch(b)
+        picks = random_choice_batch(legal, rng)
+        alive = picks >= 0
+        if not alive.any():
+            break
+        b[alive] = moved[idx[alive], picks[alive]]
+
+    return b
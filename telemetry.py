@@ -0,0 +1,134 @@
+import json
+import cProfile
+import heapq
+import pstats
+
+# per-move search telemetry. An engine given a sink fills one MoveStats per
+# get_move and hands it to sink.record(); without a sink the engines skip
+# all of this behind a single `is not None` check per node.
+
+class MoveStats:
+    def __init__(self, engine, move):
+        self.engine = engine
+        self.move = move               # move number within the engine's game
+
+        self.nodes_by_depth = {}
+        self.max_nodes = 0
+        self.chance_nodes = 0           # expanded, cache hits only in cache_hits
+        self.leaf_evals = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.rollouts = 0                # sampling engines: rollouts spent
+        self.fallbacks = 0               # nodes left static by a node budget
+
+        # seconds spent in each part of the search
+        self.movegen_time = 0
+        self.eval_time = 0
+        self.clone_time = 0
+        self.total_time = 0
+
+    def node(self, depth):
+        self.nodes_by_depth[depth] = self.nodes_by_depth.get(depth, 0) + 1
+
+    @property
+    def nodes(self):
+        return sum(self.nodes_by_depth.values())
+
+    # b such that b + b^2 + ... + b^d = nodes for the deepest depth d reached
+    @property
+    def branching_factor(self):
+        nodes = self.nodes
+        d = max(self.nodes_by_depth, default=0)
+        if d == 0 or nodes <= d:
+            return 1.0 if nodes else 0.0
+
+        lo, hi = 1.0, float(nodes)
+        for _ in range(60):
+            b = (lo + hi) / 2
+            if sum(b ** k for k in range(1, d + 1)) > nodes:
+                hi = b
+            else:
+                lo = b
+        return lo
+
+    def to_dict(self):
+        return {
+            'engine': self.engine,
+            'move': self.move,
+            'nodes': self.nodes,
+            'nodes_by_depth': {str(d): n for d, n in sorted(self.nodes_by_depth.items())},
+            'max_nodes': self.max_nodes,
+            'chance_nodes': self.chance_nodes,
+            'leaf_evals': self.leaf_evals,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'rollouts': self.rollouts,
+            'fallbacks': self.fallbacks,
+            'movegen_time': self.movegen_time,
+            'eval_time': self.eval_time,
+            'clone_time': self.clone_time,
+            'total_time': self.total_time,
+            'branching_factor': self.branching_factor
+        }
+
+
+# ----- sinks
+class TelemetrySink:
+    def record(self, stats):
+        raise NotImplementedError
+
+# keeps every MoveStats in memory
+class ListSink(TelemetrySink):
+    def __init__(self):
+        self.moves = []
+
+    def record(self, stats):
+        self.moves.append(stats)
+
+# calls fn(stats) for every move
+class CallbackSink(TelemetrySink):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def record(self, stats):
+        self.fn(stats)
+
+# appends one JSON line per move
+class JsonlSink(TelemetrySink):
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, stats):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(stats.to_dict()) + '\n')
+
+
+# ----- profiling
+# runs calls under cProfile and keeps the profiles of the n slowest
+class SlowestProfiler:
+    def __init__(self, n):
+        self.n = n
+        self.slowest = []   # min-heap of (time, move, pstats.Stats)
+
+    def run(self, move, fn, *args):
+        profile = cProfile.Profile()
+        profile.enable()
+        result = fn(*args)
+        profile.disable()
+
+        ps = pstats.Stats(profile)
+        entry = (ps.total_tt, move, ps)
+
+        if len(self.slowest) < self.n:
+            heapq.heappush(self.slowest, entry)
+        elif entry[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+        return result
+
+    def dump(self, path, limit = 30):
+        with open(path, 'w') as f:
+            for time, move, ps in sorted(self.slowest, key=lambda e: -e[0]):
+                f.write('===== move %d: %f s\n' % (move, time))
+                ps.stream = f
+                ps.sort_stats('cumulative').print_stats(limit)
@@ -0,0 +1,127 @@
+import numpy as np
+from random import Random
+from game_board import GameBoard, move_grid
+from exp_board import ExpBoard, move_exps, grid_to_exps
+from bit_board import BitBoard, move_packed, move_score_packed, packed_to_grid, UP, DOWN, LEFT, RIGHT
+from heuristics import eval_packed, eval_packed_tables, get_heuristic_tables
+
+# the board kernels are separate implementations of the same game, these
+# check them against a plain reference and against each other
+
+SEED = 2048
+N_BOARDS = 300
+
+# packed board with every cell empty or a tile up to 2048
+def random_board(rng):
+    b = 0
+    for k in range(16):
+        if rng.random() < 0.6:
+            b |= rng.randint(1, 11) << (4 * k)
+    return b
+
+def exps_of(b):
+    return [[(b >> (4 * (4 * i + j))) & 0xF for j in range(4)] for i in range(4)]
+
+# cells of line k in the order dir slides them, first cell first
+def line(dir, k):
+    if dir == LEFT:
+        return [(k, n) for n in range(4)]
+    if dir == RIGHT:
+        return [(k, 3 - n) for n in range(4)]
+    if dir == UP:
+        return [(n, k) for n in range(4)]
+    return [(3 - n, k) for n in range(4)]
+
+# exponent grid after moving dir and the merge score, one merge per tile
+def reference_move(exps, dir):
+    out = [[0] * 4 for _ in range(4)]
+    score = 0
+    for k in range(4):
+        cells = line(dir, k)
+        tiles = [exps[i][j] for i, j in cells if exps[i][j]]
+        merged = []
+        n = 0
+        while n < len(tiles):
+            if n + 1 < len(tiles) and tiles[n] == tiles[n + 1]:
+                merged.append(tiles[n] + 1)
+                score += 1 << (tiles[n] + 1)
+                n += 2
+            else:
+                merged.append(tiles[n])
+                n += 1
+        for (i, j), e in zip(cells, merged):
+            out[i][j] = e
+    return out, score
+
+def test_move_kernels_match_reference():
+    rng = Random(SEED)
+    for _ in range(N_BOARDS):
+        b = random_board(rng)
+        grid = packed_to_grid(b)
+        exps = grid_to_exps(grid)
+
+        for dir in (UP, DOWN, LEFT, RIGHT):
+            want, want_score = reference_move(exps_of(b), dir)
+            want_changed = want != exps_of(b)
+
+            out = np.zeros((4, 4))
+            changed, score = move_grid(grid, out, dir)
+            assert (changed, score) == (want_changed, want_score)
+            assert grid_to_exps(out).tolist() == want
+
+            out = np.zeros((4, 4), dtype=np.uint8)
+            changed, score = move_exps(exps, out, dir)
+            assert (changed, score) == (want_changed, want_score)
+            assert out.tolist() == want
+
+            moved = move_packed(b, dir)
+            assert exps_of(moved) == want
+            assert (moved != b) == want_changed
+            assert move_score_packed(b, dir) == want_score
+
+def test_evaluations_match():
+    rng = Random(SEED)
+    tables = get_heuristic_tables()
+    for _ in range(N_BOARDS):
+        b = random_board(rng)
+        board = GameBoard(packed_to_grid(b))
+        n_empty = board.count_empty()
+
+        for symmetric in (False, True):
+            want = eval_packed(np.uint64(b), n_empty, symmetric)
+            assert board.evaluate(n_empty, symmetric) == want
+            assert eval_packed_tables(np.uint64(b), n_empty, symmetric, tables) == want
+
+# the three boards through whole random games: same positions, scores and
+# moves, and GameBoard's running terms always equal a fresh evaluation
+def test_boards_play_alike():
+    rng = Random(SEED)
+    for _ in range(10):
+        boards = [GameBoard(), ExpBoard(), BitBoard()]
+
+        while True:
+            cells = boards[2].get_available_cells()
+            if cells:
+                pos = cells[rng.randint(0, len(cells) - 1)]
+                value = 2 if rng.random() < 0.9 else 4
+                for board in boards:
+                    board.insert_tile(pos, value)
+
+            assert len({board.key() for board in boards}) == 1
+            assert len({board.score for board in boards}) == 1
+            assert len({board.get_max_tile() for board in boards}) == 1
+            assert len({board.count_empty() for board in boards}) == 1
+
+            n_empty = boards[0].count_empty()
+            key = np.uint64(boards[0].key())
+            for symmetric in (False, True):
+                assert boards[0].evaluate(n_empty, symmetric) == eval_packed(key, n_empty, symmetric)
+
+            moves = boards[0].get_available_moves()
+            assert all(board.get_available_moves() == moves for board in boards)
+            if not moves:
+                break
+
+            dir = moves[rng.randint(0, len(moves) - 1)]
+            for board in boards:
+                board.move(dir)
@@ -0,0 +1,28 @@
+import pytest
+from main_batch import play_game, play_lockstep
+
+# play_lockstep shares the leaf evaluations of its games but must play each
+# of them exactly as play_game does with batch_leaves on
+
+SEEDS = (1, 2, 3)
+SAME = ('max_tile', 'score', 'total_moves', 'states_visited', 'fallbacks',
+        'cache_hits', 'cache_misses', 'cache_evictions')
+
+@pytest.mark.parametrize('board', ['GameBoard', 'BitBoard'])
+def test_lockstep_plays_like_play_game(board):
+    options = {'board': board, 'node_budget': 20, 'lockstep': len(SEEDS)}
+    games = [(n, seed, 'test', options) for n, seed in enumerate(SEEDS)]
+
+    lockstep = play_lockstep(games)
+    for (n, seed, run_id, _), got in zip(games, lockstep):
+        want = play_game((n, seed, run_id, dict(options, batch_leaves=True)))
+        assert {k: got[k] for k in SAME} == {k: want[k] for k in SAME}
+
+@pytest.mark.parametrize('options', [{'telemetry': True}, {'profile_slowest': 3}, {'symmetric': True}])
+def test_lockstep_rejects_unsupported_options(options):
+    with pytest.raises(ValueError):
+        play_lockstep([(0, 1, 'test', options)])
+
+def test_lockstep_rejects_mixed_options():
+    with pytest.raises(ValueError):
+        play_lockstep([(0, 1, 'test', {'node_budget': 20}), (1, 2, 'test', {'node_budget': 40})])
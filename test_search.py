@@ -0,0 +1,46 @@
+import os
+import json
+import pytest
+from ai import Expectimax
+from game_board import GameBoard
+from exp_board import ExpBoard
+from bit_board import BitBoard, packed_to_grid
+
+# the search options trade speed for memory or pruning, none of them may
+# change the move or utility maximize() finds
+
+with open(os.path.join(os.path.dirname(__file__), 'bench_positions.json')) as f:
+    CORPUS = json.load(f)
+POSITIONS = [key for phase in ('early', 'mid', 'late') for key in CORPUS[phase]]
+
+BOARDS = {
+    'GameBoard': lambda key: GameBoard(packed_to_grid(key)),
+    'ExpBoard': lambda key: ExpBoard.from_grid(packed_to_grid(key)),
+    'BitBoard': BitBoard,
+}
+
+@pytest.mark.parametrize('cache_size', [200000, 0])
+def test_bounded_matches_maximize(cache_size):
+    full = Expectimax(cache_size=cache_size)
+    bounded = Expectimax(cache_size=cache_size, bounded=True)
+    for key in POSITIONS:
+        want_move, want = full.maximize(BitBoard(key))
+        move, utility, exact = bounded.maximize_bounded(BitBoard(key))
+        assert exact
+        assert move == want_move
+        assert utility == pytest.approx(want, rel=1e-9)
+
+@pytest.mark.parametrize('board', list(BOARDS))
+@pytest.mark.parametrize('option', [{'board_stack': True}, {'batch_leaves': True}, {'eval_tables': True},
+                                    {'node_budget': 10 ** 9}])
+def test_options_match_maximize(board, option):
+    make = BOARDS[board]
+    plain = Expectimax()
+    ai = Expectimax(**option)
+    for key in POSITIONS:
+        ai.start_budget(ai.node_budget)
+        want_move, want = plain.maximize(make(key))
+        move, utility = ai.maximize(make(key))
+        assert move == want_move
+        assert utility == pytest.approx(want, rel=1e-9)
+        assert ai.states_visited == plain.states_visited